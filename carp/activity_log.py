@@ -0,0 +1,95 @@
+import os
+import gzip
+import time
+import shutil
+import threading
+from datetime import datetime
+
+
+class ActivityLogger:
+    """
+    Buffered writer of a stash activity log.
+
+    Lines are kept in memory and written at once when flush_lines of them
+    are waiting, or when the oldest one waited for flush_delay seconds.
+    The log is rotated when it grows over max_size bytes, keeping the
+    given number of older generations, optionally gzipped. Entries are
+    also inserted in the given ActivityStore, if any. It may be shared by
+    several threads.
+    """
+    flush_lines = 100
+    flush_delay = 1
+
+    def __init__(self, log_file, max_size=256 * 1024, generations=3,
+                 compress=False, store=None):
+        self.log_file = log_file
+        self.store = store
+        self.max_size = max_size
+        self.generations = generations
+        self.compress = compress
+        self.buffer = []
+        self.entries = []
+        self.buffered_since = None
+        self.lock = threading.RLock()
+        try:
+            self.size = os.path.getsize(log_file)
+        except OSError:
+            self.size = 0
+
+    def log(self, activity, path=None, status=None):
+        now = time.time()
+        with self.lock:
+            self.buffer.append("[{0}] {1}\n".format(
+                datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S"),
+                activity))
+            self.entries.append((now, path, status, activity))
+            if self.buffered_since is None:
+                self.buffered_since = time.monotonic()
+            if len(self.buffer) >= self.flush_lines:
+                self.flush()
+
+    def maybe_flush(self):
+        if self.buffered_since is not None and \
+           time.monotonic() - self.buffered_since >= self.flush_delay:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
+            data = "".join(self.buffer)
+            entries = self.entries
+            self.buffer = []
+            self.entries = []
+            self.buffered_since = None
+            with open(self.log_file, "a") as f:
+                f.write(data)
+            if self.store is not None:
+                self.store.add(entries)
+            self.size += len(data.encode())
+            if self.size > self.max_size:
+                self.rotate()
+
+    def generation_file(self, number):
+        name = "{}.{}".format(self.log_file, number)
+        if self.compress:
+            name += ".gz"
+        return name
+
+    def rotate(self):
+        if self.generations < 1:
+            os.truncate(self.log_file, 0)
+            self.size = 0
+            return
+        for number in range(self.generations - 1, 0, -1):
+            older = self.generation_file(number)
+            if os.path.exists(older):
+                os.replace(older, self.generation_file(number + 1))
+        if self.compress:
+            with open(self.log_file, "rb") as f_in, \
+                 gzip.open(self.generation_file(1), "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.truncate(self.log_file, 0)
+        else:
+            os.replace(self.log_file, self.generation_file(1))
+        self.size = 0
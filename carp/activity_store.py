@@ -0,0 +1,102 @@
+import re
+import time
+import sqlite3
+from datetime import datetime, timedelta
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    path TEXT,
+    status TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activity_time ON activity (time);
+CREATE INDEX IF NOT EXISTS activity_path ON activity (path, time);
+"""
+
+RELATIVE_SINCE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_since(since):
+    """
+    Return the timestamp matching since, which may be "today",
+    "yesterday", a relative duration like "30m", "2h" or "3d", or a
+    date like "2020-04-01" or "2020-04-01 12:00".
+    """
+    now = datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if since == "today":
+        return today.timestamp()
+    if since == "yesterday":
+        return (today - timedelta(days=1)).timestamp()
+    relative = re.match(r"^([0-9]+)([smhdw])$", since)
+    if relative is not None:
+        seconds = int(relative[1]) * RELATIVE_SINCE_UNITS[relative[2]]
+        return time.time() - seconds
+    for date_format in ["%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            return datetime.strptime(since, date_format).timestamp()
+        except ValueError:
+            continue
+    raise ValueError("Unknown date format: {}".format(since))
+
+
+class ActivityStore:
+    """
+    SQLite store of a stash activity, indexed on time and path.
+
+    The database is opened in WAL mode, so that the sync daemon can keep
+    writing in it while other processes query it. Only the last
+    max_entries entries are kept, 0 meaning no limit.
+    """
+    def __init__(self, db_file, max_entries=0):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        # Writes may come from several threads of the GUI, they are
+        # serialized by the ActivityLogger.
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, entries):
+        """Insert (time, path, status, message) entries at once."""
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO activity (time, path, status, message) "
+                "VALUES (?, ?, ?, ?)", entries)
+            if self.max_entries > 0:
+                self.db.execute(
+                    "DELETE FROM activity WHERE id <= "
+                    "(SELECT MAX(id) FROM activity) - ?",
+                    (self.max_entries,))
+
+    def query(self, since=None, path_prefix=None, limit=None,
+              changes_only=False):
+        """Return the last matching entries, oldest first."""
+        clauses = []
+        params = []
+        if since is not None:
+            clauses.append("time >= ?")
+            params.append(since)
+        path_prefix = (path_prefix or "").rstrip("/")
+        if path_prefix:
+            # The path itself, or anything below it. Range condition, to
+            # use the path index, "0" being the character after "/".
+            clauses.append("(path = ? OR (path >= ? AND path < ?))")
+            params += [path_prefix, path_prefix + "/", path_prefix + "0"]
+        elif changes_only:
+            clauses.append("path IS NOT NULL")
+        sql = "SELECT time, path, status, message FROM activity"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY time DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return list(reversed(self.db.execute(sql, params).fetchall()))
@@ -1,11 +1,16 @@
 import os
 import sys
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from carp.stash_manager import StashManager, CarpNotAStashError, \
     CarpMountError, CarpNoRemoteError, CarpNotEmptyDirectoryError, \
     CarpSubcommandError, CarpMustBePushedError
+from carp.activity_store import parse_since
 from carp import __version__, __description__
 from xdg.BaseDirectory import xdg_config_home
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from argparse import ArgumentParser, ArgumentTypeError, \
+    RawDescriptionHelpFormatter
 
 import gettext
 # Uncomment the following line during development.
@@ -15,6 +20,24 @@ gettext.textdomain("carp")
 _ = gettext.gettext
 
 
+def since_type(since):
+    try:
+        return parse_since(since)
+    except ValueError:
+        raise ArgumentTypeError(_("{0} is not a valid date.").format(since))
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(
+            _("{0} is not a positive number.").format(value))
+    return number
+
+
 class CarpCli:
     def __init__(self):
         self.parse_args()
@@ -40,15 +63,74 @@ class CarpCli:
             else:
                 work_on_stash = carp.unmounted_stashes()
 
-            for st in work_on_stash:
-                print(_("Working on {0}").format(st))
-                self.options["stash"] = st
-                self.run(carp, False)
+            if self.options["jobs"] > 1:
+                failed = self.run_parallel(carp, config_file, work_on_stash)
+            else:
+                failed = []
+                for st in work_on_stash:
+                    print(_("Working on {0}").format(st))
+                    self.options["stash"] = st
+                    if self.run(carp, False) is False:
+                        failed.append(st)
+
+            print(_("{0} succeeded, {1} failed.").format(
+                len(work_on_stash) - len(failed), len(failed)))
+            if any(failed):
+                self.die(_("Failed stashes: {0}").format(", ".join(failed)))
 
         else:
             self.run(carp)
         sys.exit(0)
 
+    def stash_command(self, config_file, stash_name):
+        cmd = [sys.executable, "-m", "carp.carpcli", "-c", config_file,
+               self.command, stash_name]
+        if self.options.get("test"):
+            cmd.append("-t")
+        if self.options.get("nosync"):
+            cmd.append("-n")
+        return cmd
+
+    def run_parallel(self, carp, config_file, stashes):
+        """
+        Run the current command on the given stashes, each one in its
+        own carp process, with at most jobs of them at once. Their output
+        is prefixed with their stash name. Return the failed stashes.
+        """
+        failed = []
+        if self.command == "mount":
+            # Password prompts cannot be shared, ask them one at a time
+            interactive = [st for st in stashes
+                           if not carp.stashes[st]["pass_file"]]
+            for st in interactive:
+                print(_("Working on {0}").format(st))
+                self.options["stash"] = st
+                if self.run(carp, False) is False:
+                    failed.append(st)
+            stashes = [st for st in stashes if st not in interactive]
+
+        output_lock = threading.Lock()
+
+        def run_one(stash_name):
+            proc = subprocess.Popen(
+                self.stash_command(config_file, stash_name),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            with proc:
+                for line in proc.stdout:
+                    with output_lock:
+                        print("[{0}] {1}".format(
+                            stash_name,
+                            line.decode(errors="replace").rstrip("\n")),
+                            flush=True)
+            return proc.returncode
+
+        with ThreadPoolExecutor(max_workers=self.options["jobs"]) as pool:
+            results = pool.map(run_one, stashes)
+            failed += [st for st, returncode in zip(stashes, results)
+                       if returncode != 0]
+        return failed
+
     def die(self, msg, error_code=1):
         print(msg, file=sys.stderr)
         sys.exit(error_code)
@@ -81,6 +163,13 @@ For exemple: %(prog)s create --help
                                  action="store_true",
                                  help=_("Ignore sync feature."))
 
+        jobs_parser = ArgumentParser(add_help=False)
+        jobs_parser.add_argument("-j", "--jobs", type=positive_int,
+                                 default=1,
+                                 help=_("When stash is 'all', work on this "
+                                        "number of stashes at once "
+                                        "(default: 1)."))
+
         subparsers = parser.add_subparsers(
             dest="command", help=None,
             metavar="COMMAND", description=None)
@@ -90,16 +179,18 @@ For exemple: %(prog)s create --help
             "create", help=_("Create a new EncFS stash."))
         subparsers.add_parser(
             "mount", help=_("Mount an existing EncFS stash."),
-            parents=[parent_parser, sync_parser])
+            parents=[parent_parser, sync_parser, jobs_parser])
         subparsers.add_parser(
             "umount", help=_("Unmount a currently mounted EncFS stash."),
-            parents=[parent_parser, sync_parser])
+            parents=[parent_parser, sync_parser, jobs_parser])
         subparsers.add_parser(
             "pull", help=_("Pull a distant stash."),
-            parents=[parent_parser])
+            parents=[parent_parser, jobs_parser])
         subparsers.add_parser(
             "push", help=_("Push a distant stash."),
-            parents=[parent_parser])
+            parents=[parent_parser, jobs_parser])
+        parser_activity = subparsers.add_parser(
+            "activity", help=_("Display the last changes of a stash."))
 
         parser_create.add_argument(
             "-s", "--save-pass", action="store_true",
@@ -111,6 +202,20 @@ For exemple: %(prog)s create --help
             "rootdir", help=_("The path to an empty folder, which will "
                               "become the encrypted stash."))
 
+        parser_activity.add_argument("stash", help=_("Stash to handle."))
+        parser_activity.add_argument(
+            "-s", "--since", type=since_type,
+            help=_("Only display changes since this date. It may be "
+                   "'today', 'yesterday', a duration like '2h' or '3d', "
+                   "or a date like '2020-04-01 12:00'."))
+        parser_activity.add_argument(
+            "-p", "--path",
+            help=_("Only display changes under this path, relative to "
+                   "the stash mount point."))
+        parser_activity.add_argument(
+            "-l", "--limit", type=int, default=10,
+            help=_("Maximum number of changes to display (default: 10)."))
+
         parser_list.add_argument(
             "state", nargs="?", default="mounted",
             choices=["mounted", "unmounted", "all"],
@@ -138,6 +243,14 @@ For exemple: %(prog)s create --help
                 "state": args.state,
                 "raw": args.raw
             }
+        elif self.command == "activity":
+            return {
+                "config": args.config,
+                "stash": args.stash,
+                "since": args.since,
+                "path": args.path,
+                "limit": args.limit
+            }
         elif self.command == "create":
             return {
                 "config": args.config,
@@ -148,7 +261,8 @@ For exemple: %(prog)s create --help
         opts = {
             "config": args.config,
             "stash": args.stash,
-            "test": args.test
+            "test": args.test,
+            "jobs": args.jobs
         }
         if self.command in ["mount", "umount"]:
             opts["nosync"] = args.nosync
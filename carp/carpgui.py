@@ -1,12 +1,18 @@
 import os
 import re
 import sys
+import time
 import signal
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from carp.stash_manager import StashManager, CarpNotAStashError, \
     CarpMountError, CarpNoRemoteError, CarpNotEmptyDirectoryError, \
-    CarpMustBePushedError
+    CarpMustBePushedError, CarpSubcommandError, \
+    CARP_DEFAULT_HIDE_FILE_PATTERN
+from carp.activity_store import ActivityStore
 from carp import __version__, __description__, __generic_name__
 from xdg.BaseDirectory import xdg_config_home
 
@@ -39,20 +45,151 @@ CARP_POSSIBLE_INOTIFY_STATUS = {
 }
 
 
+class StashStateModel:
+    """
+    Last known state of every stash, refreshed by a background thread.
+
+    The list of stashes and their mount state are published first, then
+    the slow fields (space usage and last changes) one stash at a time.
+    Each update is handed to the on_change callback in the GTK main loop,
+    as (stash_name, field) or (None, None) when the whole list changed.
+    """
+    refresh_interval = 60
+
+    def __init__(self, sm, lock_re, on_change):
+        self.sm = sm
+        self.lock_re = lock_re
+        self.on_change = on_change
+        # Only used from the GTK main loop
+        self.mounted = []
+        self.unmounted = []
+        self.stashes = {}
+        self.loaded = False
+        self.error = False
+        self.wakeup = threading.Event()
+        self.wakeup.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def refresh(self):
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.refresh_interval)
+            self.wakeup.clear()
+            self.update()
+
+    def update(self):
+        # Any error is reported, but must not end this thread, which
+        # would leave the menu stale for good.
+        try:
+            self.sm.reload_stashes()
+            mounted = self.sm.mounted_stashes()
+            unmounted = self.sm.unmounted_stashes(mounted)
+            stashes = {}
+            for st in mounted + unmounted:
+                stashes[st] = {
+                    "mounted": st in mounted,
+                    "may_sync": self.sm.may_sync(st),
+                    "activity_db": self.sm.stashes[st]["activity_db"]}
+            error = False
+        except Exception:
+            mounted = []
+            unmounted = []
+            stashes = {}
+            error = True
+        GLib.idle_add(self.publish_stashes, mounted, unmounted,
+                      stashes, error)
+
+        for st in mounted + unmounted:
+            try:
+                size = self.sm.file_space_usage(st, stashes[st]["mounted"])
+            except Exception:
+                # Stash removed or moved meanwhile, or unreadable
+                size = None
+            GLib.idle_add(self.publish_field, st, "size", size)
+            if stashes[st]["mounted"]:
+                try:
+                    last_changes = self.last_changes(
+                        st, stashes[st]["activity_db"])
+                except Exception:
+                    last_changes = None
+                GLib.idle_add(self.publish_field, st, "last_changes",
+                              last_changes)
+
+    def last_changes(self, stash_name, db_file):
+        if not os.path.exists(db_file):
+            return []
+        store = ActivityStore(db_file)
+        try:
+            # Only decode ciphertext paths of the entries we may display
+            entries = store.query(limit=50, changes_only=True)
+        finally:
+            store.close()
+
+        paths = self.sm.plaintext_paths(stash_name, [e[1] for e in entries])
+
+        modified_files = []
+        last_line = None
+        for (when, _path, status, _msg), concerned_path in zip(entries, paths):
+            concerned_file = os.path.basename(concerned_path)
+            if self.lock_re.search(concerned_file) is not None:
+                continue
+            new_line = "{}{}".format(concerned_path, status)
+            if new_line == last_line:
+                continue
+            last_line = new_line
+            modified_files.append(
+                (datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S"),
+                 concerned_path, status))
+        return modified_files[-10:]
+
+    def publish_stashes(self, mounted, unmounted, stashes, error):
+        for st, state in stashes.items():
+            previous = self.stashes.get(st)
+            if previous is not None and \
+               previous["mounted"] == state["mounted"]:
+                # Keep the slow fields until fresh ones arrive
+                state["size"] = previous.get("size")
+                state["last_changes"] = previous.get("last_changes")
+        self.mounted = mounted
+        self.unmounted = unmounted
+        self.stashes = stashes
+        self.loaded = True
+        self.error = error
+        self.on_change(None, None)
+        return False
+
+    def publish_field(self, stash_name, field, value):
+        if stash_name not in self.stashes:
+            return False
+        self.stashes[stash_name][field] = value
+        self.on_change(stash_name, field)
+        return False
+
+
 class CarpGui:
+    # Actions of different stashes may run at the same time
+    action_workers = 4
+    progress_notify_delay = 5
+
     def __init__(self):
-        self.activity_re = re.compile(
-            r"^\[([0-9\s:-]+)\] (.+) (created|deleted|modified|moved)$"
-        )
         self.parse_args()
         self.sm = StashManager(self.config_file)
 
         hide_file_pattern = self.sm.config["general"].get(
-            "hide_file_pattern",
-            r"(?:^\.~.+\#|^\.\#|~$|\.lock$|~\.[A-Z0-9]{6}$)"
+            "hide_file_pattern", CARP_DEFAULT_HIDE_FILE_PATTERN
         )
         self.lock_re = re.compile(hide_file_pattern)
 
+        self.menu_items = {}
+        self.notified_error = False
+        self.actions = ThreadPoolExecutor(max_workers=self.action_workers)
+        self.running = {}
+        self.model = StashStateModel(self.sm, self.lock_re,
+                                     self.model_changed)
+
         Notify.init("Carp")
 
         self.must_autostart = os.path.isfile(os.path.join(
@@ -82,30 +219,7 @@ class CarpGui:
         if args.config:
             self.config_file = os.path.expanduser(args.config)
 
-    def build_activity_submenu(self, log_file):
-        file_lines = []
-        with open(log_file, "r") as f:
-            file_lines = f.readlines()
-
-        modified_files = []
-        last_line = None
-        for line in file_lines:
-            match = self.activity_re.match(line)
-            if match is None:
-                continue
-            concerned_file = os.path.basename(match[2])
-            if self.lock_re.search(concerned_file) is not None:
-                continue
-            new_line = "{}{}".format(match[2], match[3])
-            if new_line == last_line:
-                continue
-            last_line = new_line
-            modified_files.append((match[1], match[2], match[3]))
-
-        if len(modified_files) == 0:
-            return None
-
-        modified_files = modified_files[-10:]
+    def build_activity_submenu(self, modified_files):
         lfmenu = Gtk.Menu()
         for line in modified_files:
             istatus = CARP_POSSIBLE_INOTIFY_STATUS[line[2]]
@@ -117,16 +231,42 @@ class CarpGui:
                 lb.connect("activate", self.open_in_file_browser,
                            line[1], True)
             lfmenu.append(lb)
-
         return lfmenu
 
+    def size_label(self, stash_name):
+        size = self.model.stashes[stash_name].get("size")
+        if size is None:
+            return _("Computing space usage…")
+        return _("Use {0} of space").format(size)
+
+    def update_last_changes_item(self, lfmb, stash_name):
+        modified_files = self.model.stashes[stash_name].get("last_changes")
+        if not modified_files:
+            lfmb.set_sensitive(False)
+            return
+        lfmenu = self.build_activity_submenu(modified_files)
+        lfmenu.show_all()
+        lfmb.set_submenu(lfmenu)
+        lfmb.set_sensitive(True)
+
     def build_stash_submenu(self, stash_name, is_unmounted=True):
         mm = Gtk.Menu()
+        items = {}
 
         current_state_info = Gtk.MenuItem.new_with_label(
-            _("Use {0} of space").format(self.sm.file_space_usage(stash_name)))
+            self.size_label(stash_name))
         current_state_info.set_sensitive(False)
         mm.append(current_state_info)
+        items["size"] = current_state_info
+
+        # Only one action at a time for a given stash
+        busy = stash_name in self.running
+        if busy:
+            progress_info = Gtk.MenuItem.new_with_label(
+                self.progress_label(stash_name))
+            progress_info.set_sensitive(False)
+            mm.append(progress_info)
+            items["progress"] = progress_info
 
         mount_label = _("Unmount {0}").format(stash_name)
         mount_action = "umount"
@@ -134,35 +274,30 @@ class CarpGui:
             mount_label = _("Mount {0}").format(stash_name)
             mount_action = "mount"
         else:
-            log_file = os.path.join(xdg_config_home, "carp",
-                                    stash_name, "activity.log")
-
             lfmb = Gtk.MenuItem.new_with_label(_("Last changes"))
-            lfmb.set_sensitive(False)
-            if os.path.exists(log_file):
-                lfmenu = self.build_activity_submenu(log_file)
-                if lfmenu is not None:
-                    lfmb.set_sensitive(True)
-                    lfmb.set_submenu(lfmenu)
-
+            self.update_last_changes_item(lfmb, stash_name)
             mm.append(lfmb)
+            items["last_changes"] = lfmb
 
         mi_button = Gtk.MenuItem.new_with_label(mount_label)
         mi_button.connect("activate", self.encfs_action,
                           mount_action, stash_name)
+        mi_button.set_sensitive(not busy)
         mm.append(mi_button)
 
-        if is_unmounted and self.sm.may_sync(stash_name):
+        if is_unmounted and self.model.stashes[stash_name]["may_sync"]:
             mi_button = Gtk.MenuItem.new_with_label(
                 _("Pull {0}").format(stash_name))
             mi_button.connect("activate", self.encfs_action,
                               "pull", stash_name)
+            mi_button.set_sensitive(not busy)
             mm.append(mi_button)
 
             mi_button = Gtk.MenuItem.new_with_label(
                 _("Push {0}").format(stash_name))
             mi_button.connect("activate", self.encfs_action,
                               "push", stash_name)
+            mi_button.set_sensitive(not busy)
             mm.append(mi_button)
         elif not is_unmounted:
             mi_button = Gtk.MenuItem.new_with_label(_("Open"))
@@ -174,22 +309,43 @@ class CarpGui:
             mi_button.connect("activate", self.open_in_term, stash_name)
             mm.append(mi_button)
 
+        self.menu_items[stash_name] = items
         mb = Gtk.MenuItem.new_with_label(stash_name)
         mb.set_submenu(mm)
         return mb
 
+    def model_changed(self, stash_name, field):
+        if stash_name is None:
+            if self.model.error and not self.notified_error:
+                self.notify(_("An error occured while retrieving your "
+                              "stashes' list"), Notify.Urgency.CRITICAL)
+            self.notified_error = self.model.error
+            # The opened menu, if any, is left as is. It will be
+            # rendered again from the new list the next time.
+            return
+        item = self.menu_items.get(stash_name, {}).get(field)
+        if item is None:
+            return
+        if field == "size":
+            item.set_label(self.size_label(stash_name))
+        elif field == "last_changes":
+            self.update_last_changes_item(item, stash_name)
+
     def display_menu(self, icon, event_button, event_time):
         menu = Gtk.Menu()
 
-        try:
-            self.sm.reload_stashes()
-            mounted_stashes = self.sm.mounted_stashes()
-            unmounted_stashes = self.sm.unmounted_stashes()
-        except (FileNotFoundError, NotADirectoryError):
-            mounted_stashes = []
-            unmounted_stashes = []
-            self.notify(_("An error occured while retrieving your "
-                          "stashes' list"), Notify.Urgency.CRITICAL)
+        # Render the last known state at once, and ask for a fresh one
+        self.menu_items = {}
+        mounted_stashes = self.model.mounted
+        unmounted_stashes = self.model.unmounted
+        self.model.refresh()
+
+        if not self.model.loaded:
+            loading = Gtk.MenuItem.new_with_label(_("Loading stashes…"))
+            loading.set_sensitive(False)
+            menu.append(loading)
+            sep = Gtk.SeparatorMenuItem()
+            menu.append(sep)
 
         if any(mounted_stashes):
             for st in mounted_stashes:
@@ -233,26 +389,88 @@ class CarpGui:
     def encfs_action(self, widget, action, stash_name):
         if action not in ["mount", "umount", "pull", "push"]:
             return False
+        if stash_name in self.running:
+            return False
 
         cmd_opts = {"stash": stash_name}
         if action == "mount" and not self.sm.stashes[stash_name]["pass_file"]:
             cmd_opts["pass_cmd"] = "zenity --password"
-
+        if action in ["umount", "pull", "push"]:
+            cmd_opts["progress"] = lambda progress: GLib.idle_add(
+                self.action_progress, stash_name, progress)
+
+        self.running[stash_name] = {
+            "action": action,
+            "progress": None,
+            "notified_at": time.monotonic(),
+            "notification": self.notify(self.progress_label_for(
+                stash_name, action, None))
+        }
+        self.update_tooltip()
+        future = self.actions.submit(self.run_action, action, cmd_opts)
+        future.add_done_callback(lambda future: GLib.idle_add(
+            self.action_done, stash_name,
+            future.exception() is None and future.result()))
+
+    def run_action(self, action, cmd_opts):
+        # Called in a worker thread
         try:
-            success = getattr(self.sm, action)(cmd_opts)
+            return getattr(self.sm, action)(cmd_opts)
         except (CarpMountError, CarpNotEmptyDirectoryError,
                 CarpNotAStashError, CarpNoRemoteError,
-                CarpMustBePushedError):
-            success = False
+                CarpMustBePushedError, CarpSubcommandError):
+            return False
 
+    def progress_label_for(self, stash_name, action, progress):
+        if progress is None:
+            return _("{1}ing {0}…").format(
+                stash_name, CARP_POSSIBLE_STATUS[action])
+        return _("{1}ing {0}: {2}% at {3}, {4} left").format(
+            stash_name, CARP_POSSIBLE_STATUS[action], progress.percent,
+            progress.speed, progress.eta)
+
+    def progress_label(self, stash_name):
+        state = self.running[stash_name]
+        return self.progress_label_for(
+            stash_name, state["action"], state["progress"])
+
+    def update_tooltip(self):
+        lines = ["Carp"] + [self.progress_label(st) for st in self.running]
+        self.tray.set_tooltip_text("\n".join(lines))
+
+    def action_progress(self, stash_name, progress):
+        state = self.running.get(stash_name)
+        if state is None:
+            return False
+        state["progress"] = progress
+        label = self.progress_label(stash_name)
+        item = self.menu_items.get(stash_name, {}).get("progress")
+        if item is not None:
+            item.set_label(label)
+        self.update_tooltip()
+        now = time.monotonic()
+        if now - state["notified_at"] >= self.progress_notify_delay:
+            state["notified_at"] = now
+            self.notify(label, nota=state["notification"])
+        return False
+
+    def action_done(self, stash_name, success):
+        state = self.running.pop(stash_name)
+        action = state["action"]
+        self.update_tooltip()
+        item = self.menu_items.get(stash_name, {}).get("progress")
         if success:
-            self.notify(_("{0} correctly {1}ed")
-                        .format(stash_name, CARP_POSSIBLE_STATUS[action]))
-
+            msg = _("{0} correctly {1}ed").format(
+                stash_name, CARP_POSSIBLE_STATUS[action])
+            self.notify(msg, nota=state["notification"])
         else:
-            self.notify(_("An error occured while {1}ing {0}")
-                        .format(stash_name, CARP_POSSIBLE_STATUS[action]),
-                        Notify.Urgency.CRITICAL)
+            msg = _("An error occured while {1}ing {0}").format(
+                stash_name, CARP_POSSIBLE_STATUS[action])
+            self.notify(msg, Notify.Urgency.CRITICAL, state["notification"])
+        if item is not None:
+            item.set_label(msg)
+        self.model.refresh()
+        return False
 
     def open_in_file_browser(self, widget, stash_name_or_path,
                              absolute_path=False):
@@ -268,10 +486,15 @@ class CarpGui:
         os.chdir(target_folder)
         subprocess.Popen(["st"])
 
-    def notify(self, msg, urgency=Notify.Urgency.NORMAL):
-        nota = Notify.Notification.new("Carp", msg)
+    def notify(self, msg, urgency=Notify.Urgency.NORMAL, nota=None):
+        if nota is None:
+            nota = Notify.Notification.new("Carp", msg)
+        else:
+            # Replace the previous content of this notification
+            nota.update("Carp", msg, None)
         nota.set_urgency(urgency)
         nota.show()
+        return nota
 
     def toggle_must_autostart(self, widget):
         self.must_autostart = widget.get_active()
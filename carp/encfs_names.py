@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+
+class EncFSNames:
+    """
+    Translate plaintext paths of a stash to their ciphertext names, and
+    back.
+
+    Translation is done by encfsctl, which needs the stash password. It
+    is thus only available for stashes with a saved password. EncFS name
+    encoding only depends on the volume key and the plaintext path, so
+    translated names are cached for the whole life of the object.
+    """
+    batch_size = 500
+
+    def __init__(self, encfs_root, config_file, pass_file=None):
+        self.encfs_root = encfs_root
+        self.config_file = config_file
+        self.extpass = None
+        if pass_file is not None:
+            self.extpass = "gpg -q -d {}".format(pass_file)
+        self.encoded = {}
+        self.decoded = {}
+
+    def available(self):
+        return self.extpass is not None
+
+    def _encfsctl(self, action, paths):
+        env = os.environ.copy()
+        env["ENCFS6_CONFIG"] = self.config_file
+        cmd = subprocess.run(
+            ["encfsctl", action, "--extpass={}".format(self.extpass),
+             self.encfs_root] + paths,
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if cmd.returncode != 0:
+            return None
+        names = [line.strip("/") for line
+                 in os.fsdecode(cmd.stdout).split("\n")[:len(paths)]]
+        if len(names) != len(paths):
+            return None
+        return names
+
+    def _translate(self, action, cache, paths):
+        if not self.available():
+            return None
+        missing = sorted({p for p in paths if p not in cache})
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            names = self._encfsctl(action, batch)
+            if names is None:
+                return None
+            cache.update(zip(batch, names))
+        return [cache[p] for p in paths]
+
+    def encode(self, paths):
+        """
+        Return the ciphertext names of the given relative plaintext
+        paths, or None if they cannot be computed.
+        """
+        return self._translate("encode", self.encoded, paths)
+
+    def decode(self, paths):
+        """
+        Return the plaintext names of the given relative ciphertext
+        paths, or None if they cannot be computed.
+        """
+        return self._translate("decode", self.decoded, paths)
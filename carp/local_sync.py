@@ -0,0 +1,334 @@
+import os
+import stat
+import time
+import fcntl
+import errno
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from carp.rsync_progress import RsyncProgress
+from carp.space_usage import humanize_size
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Errors meaning the filesystem cannot do this kind of copy
+UNSUPPORTED_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                           errno.ENOTTY, errno.EINVAL, errno.EBADF)
+
+
+def copy_data(src_fd, dst_fd, size):
+    """
+    Copy size bytes between the given files, as a reflink if the
+    filesystem supports it, else with copy_file_range, else by hand.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_COPY_ERRORS:
+            raise
+    copied = 0
+    try:
+        while copied < size:
+            done = os.copy_file_range(src_fd, dst_fd, size - copied)
+            if done == 0:
+                break
+            copied += done
+        return
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_COPY_ERRORS or copied > 0:
+            raise
+    while True:
+        chunk = os.read(src_fd, 1024 * 1024)
+        if not chunk:
+            break
+        os.write(dst_fd, chunk)
+
+
+def same_file(src_st, dest_st):
+    # Same quick check as rsync
+    return dest_st is not None and \
+        stat.S_IFMT(src_st.st_mode) == stat.S_IFMT(dest_st.st_mode) and \
+        src_st.st_size == dest_st.st_size and \
+        src_st.st_mtime_ns == dest_st.st_mtime_ns
+
+
+def scan(path):
+    entries = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    entries[entry.name] = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return entries
+
+
+class LocalSync:
+    """
+    In-process equivalent of `rsync -a --delete source/ destination/'
+    between two local directories.
+
+    The whole plan is built before the destination is touched. Files
+    are compared by size and mtime and copied by a pool of threads into
+    temporary files, renamed once complete. Extraneous destination
+    entries are only deleted once every copy succeeded.
+    Entries of the source root whose names start with root_exclude are
+    neither copied nor deleted.
+    """
+    def __init__(self, source, destination, workers=None, dry_run=False,
+                 verbose=True, progress=None, root_exclude=None):
+        self.source = source.rstrip("/")
+        self.destination = destination.rstrip("/")
+        self.workers = workers or min(8, (os.cpu_count() or 1) * 2)
+        self.dry_run = dry_run
+        self.verbose = verbose
+        self.progress = progress
+        self.root_exclude = root_exclude
+        self.is_root = os.geteuid() == 0
+        self.copies = []
+        self.deletions = []
+        self.dirs = []
+        # Entries replaced by another kind of entry, new directories and
+        # new symbolic links, all handled once the plan is complete.
+        self.replaced = []
+        self.new_dirs = []
+        self.links = []
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.errors = 0
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def error(self, rel_path, error):
+        # Reported like rsync, which then exits with code 23
+        print("{0}: {1}".format(rel_path, error))
+        self.errors += 1
+
+    def excluded(self, rel_dir, name):
+        return rel_dir == "" and self.root_exclude is not None and \
+            name.startswith(self.root_exclude)
+
+    def plan_dir(self, rel_dir, recursive=True):
+        """Compare one directory, and its subdirectories if recursive."""
+        try:
+            src_entries = scan(os.path.join(self.source, rel_dir))
+            dest_entries = scan(os.path.join(self.destination, rel_dir))
+        except OSError as e:
+            self.error(rel_dir or ".", e)
+            return
+        for name, src_st in sorted(src_entries.items()):
+            if self.excluded(rel_dir, name):
+                continue
+            self.plan_entry(os.path.join(rel_dir, name), src_st,
+                            dest_entries.get(name), recursive)
+        for name in sorted(dest_entries):
+            if name not in src_entries and not self.excluded(rel_dir, name):
+                self.deletions.append(os.path.join(rel_dir, name))
+
+    def plan_entry(self, rel_path, src_st, dest_st, recursive=True):
+        try:
+            self.plan_kind(rel_path, src_st, dest_st, recursive)
+        except OSError as e:
+            self.error(rel_path, e)
+
+    def plan_kind(self, rel_path, src_st, dest_st, recursive):
+        if dest_st is not None and \
+           stat.S_IFMT(src_st.st_mode) != stat.S_IFMT(dest_st.st_mode):
+            # Replaced by another kind of entry
+            self.replaced.append(rel_path)
+            dest_st = None
+        if stat.S_ISDIR(src_st.st_mode):
+            if dest_st is None:
+                self.log(rel_path + "/")
+                self.new_dirs.append(rel_path)
+            self.dirs.append((rel_path, src_st))
+            if recursive:
+                self.plan_dir(rel_path)
+        elif stat.S_ISLNK(src_st.st_mode):
+            target = os.readlink(os.path.join(self.source, rel_path))
+            if dest_st is not None and target == os.readlink(
+                    os.path.join(self.destination, rel_path)):
+                return
+            self.log(rel_path)
+            self.links.append((rel_path, target, src_st))
+        elif stat.S_ISREG(src_st.st_mode):
+            if same_file(src_st, dest_st):
+                return
+            self.copies.append((rel_path, src_st))
+            self.total_bytes += src_st.st_size
+        # Like rsync without -D, special files are skipped
+
+    def remove(self, rel_path):
+        path = os.path.join(self.destination, rel_path)
+        if self.dry_run:
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def set_attributes(self, path, st):
+        if self.is_root:
+            os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def apply_plan(self):
+        """Make the planned changes but file copies and deletions."""
+        for rel_path in self.replaced:
+            try:
+                self.remove(rel_path)
+            except OSError as e:
+                self.error(rel_path, e)
+        for rel_path in self.new_dirs:
+            try:
+                os.makedirs(os.path.join(self.destination, rel_path),
+                            exist_ok=True)
+            except OSError as e:
+                self.error(rel_path, e)
+        for rel_path, target, src_st in self.links:
+            dest_path = os.path.join(self.destination, rel_path)
+            try:
+                self.remove(rel_path)
+                os.symlink(target, dest_path)
+                os.utime(dest_path, ns=(src_st.st_atime_ns,
+                                        src_st.st_mtime_ns),
+                         follow_symlinks=False)
+            except OSError as e:
+                self.error(rel_path, e)
+
+    def copy_file(self, rel_path, src_st):
+        dest_path = os.path.join(self.destination, rel_path)
+        tmp_path = os.path.join(os.path.dirname(dest_path),
+                                ".{}.carp-tmp".format(
+                                    os.path.basename(dest_path)))
+        src_fd = os.open(os.path.join(self.source, rel_path), os.O_RDONLY)
+        try:
+            dst_fd = os.open(tmp_path,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                copy_data(src_fd, dst_fd, src_st.st_size)
+            finally:
+                os.close(dst_fd)
+            self.set_attributes(tmp_path, src_st)
+            os.replace(tmp_path, dest_path)
+        except OSError:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            os.close(src_fd)
+        return src_st.st_size
+
+    def report_progress(self, start):
+        if self.progress is None or self.total_bytes == 0:
+            return
+        elapsed = max(time.monotonic() - start, 0.001)
+        speed = self.done_bytes / elapsed
+        eta = 0
+        if speed > 0:
+            eta = int((self.total_bytes - self.done_bytes) / speed)
+        self.progress(RsyncProgress(
+            self.done_bytes, self.done_bytes * 100 // self.total_bytes,
+            "{}B/s".format(humanize_size(speed)),
+            "{}:{:02d}:{:02d}".format(eta // 3600, eta // 60 % 60,
+                                      eta % 60)))
+
+    def run(self, paths=None, only_dirs=None):
+        """
+        Sync the whole tree, or only the given relative paths (deleted
+        from the destination if missing from the source), or only the
+        direct content of the given relative directories. Return the
+        number of errors.
+        """
+        if not os.path.isdir(self.source):
+            print("{0}: no such directory".format(self.source))
+            return 1
+        if not os.path.isdir(self.destination) and not self.dry_run:
+            try:
+                os.mkdir(self.destination)
+            except OSError as e:
+                self.error(self.destination, e)
+                return self.errors
+
+        if paths is not None:
+            for rel_path in paths:
+                rel_path = rel_path.strip("/")
+                try:
+                    src_st = os.stat(os.path.join(self.source, rel_path),
+                                     follow_symlinks=False)
+                except FileNotFoundError:
+                    self.deletions.append(rel_path)
+                    continue
+                except OSError as e:
+                    self.error(rel_path, e)
+                    continue
+                parent = os.path.dirname(rel_path)
+                if parent != "":
+                    self.new_dirs.append(parent)
+                try:
+                    dest_st = os.stat(
+                        os.path.join(self.destination, rel_path),
+                        follow_symlinks=False)
+                except (FileNotFoundError, NotADirectoryError):
+                    dest_st = None
+                except OSError as e:
+                    self.error(rel_path, e)
+                    continue
+                self.plan_entry(rel_path, src_st, dest_st)
+        elif only_dirs is not None:
+            for rel_dir in only_dirs:
+                rel_dir = "" if rel_dir == "." else rel_dir
+                try:
+                    src_st = os.stat(os.path.join(self.source, rel_dir))
+                except OSError as e:
+                    self.error(rel_dir or ".", e)
+                    continue
+                self.new_dirs.append(rel_dir)
+                self.plan_dir(rel_dir, recursive=False)
+                self.dirs.append((rel_dir, src_st))
+        else:
+            self.plan_dir("")
+            self.dirs.append(("", os.stat(self.source)))
+
+        if not self.dry_run:
+            self.apply_plan()
+        start = time.monotonic()
+        for rel_path, _src_st in self.copies:
+            self.log(rel_path)
+        if not self.dry_run:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [(rel_path, pool.submit(self.copy_file, rel_path,
+                                                  src_st))
+                           for rel_path, src_st in self.copies]
+                for rel_path, future in futures:
+                    try:
+                        self.done_bytes += future.result()
+                    except OSError as e:
+                        self.error(rel_path, e)
+                    self.report_progress(start)
+
+        if self.errors == 0:
+            # Like rsync, nothing is deleted after an error
+            for rel_path in self.deletions:
+                self.log("deleting {}".format(rel_path))
+                try:
+                    self.remove(rel_path)
+                except OSError as e:
+                    self.error(rel_path, e)
+
+        if not self.dry_run:
+            # Deepest first, as filling a directory changes its mtime
+            for rel_path, src_st in sorted(self.dirs, reverse=True):
+                try:
+                    self.set_attributes(
+                        os.path.join(self.destination, rel_path), src_st)
+                except OSError as e:
+                    self.error(rel_path or ".", e)
+        return self.errors
@@ -0,0 +1,75 @@
+import re
+import sys
+import subprocess
+from collections import namedtuple
+
+
+RsyncProgress = namedtuple("RsyncProgress",
+                           ["bytes", "percent", "speed", "eta"])
+
+# Lines like "  1,234,567  45%   10.23MB/s    0:00:12 (xfr#3, to-chk=10/20)"
+# The thousands separator depends on the locale.
+PROGRESS_RE = re.compile(
+    r"^\s*([0-9][0-9,.']*)\s+([0-9]+)%\s+(\S+)\s+([0-9]+:[0-9]{2}:[0-9]{2})")
+
+# Lines of the --stats summary, like "Matched data: 1,234 bytes" or
+# "Number of files: 1,234 (reg: 1,000, dir: 234)"
+STATS_RE = re.compile(r"^([A-Z][A-Za-z. ]+): ([0-9][0-9,.']*)\b")
+
+
+def parse_progress(line):
+    match = PROGRESS_RE.match(line)
+    if match is None:
+        return None
+    return RsyncProgress(int(re.sub(r"[^0-9]", "", match[1])),
+                         int(match[2]), match[3], match[4])
+
+
+def run_rsync(rsync_cmd, progress=None, stats=None):
+    """
+    Run the given rsync command and return its exit code.
+
+    If progress is given, rsync overall progress is requested, and
+    progress is called with a RsyncProgress for each of its updates.
+    If stats is given, rsync transfer statistics are requested, and
+    added to the stats dict, by name. Other lines are still written to
+    the standard output.
+    """
+    if progress is None and stats is None:
+        return subprocess.run(rsync_cmd).returncode
+
+    if progress is not None:
+        rsync_cmd = rsync_cmd[:1] + ["--info=progress2"] + rsync_cmd[1:]
+    if stats is not None:
+        rsync_cmd = rsync_cmd[:1] + ["--stats"] + rsync_cmd[1:]
+    with subprocess.Popen(rsync_cmd, stdout=subprocess.PIPE) as proc:
+        pending = b""
+        while True:
+            chunk = proc.stdout.read1(4096)
+            if not chunk:
+                break
+            # Progress updates are separated by carriage returns
+            lines = re.split(rb"[\r\n]", pending + chunk)
+            pending = lines.pop()
+            for line in lines:
+                _handle_line(line.decode(errors="replace"), progress, stats)
+        _handle_line(pending.decode(errors="replace"), progress, stats)
+    return proc.returncode
+
+
+def _handle_line(line, progress, stats):
+    if line.strip() == "":
+        return
+    if progress is not None:
+        update = parse_progress(line)
+        if update is not None:
+            progress(update)
+            return
+    if stats is not None:
+        match = STATS_RE.match(line)
+        if match is not None:
+            stats[match[1]] = stats.get(match[1], 0) + \
+                int(re.sub(r"[^0-9]", "", match[2]))
+            return
+    print(line)
+    sys.stdout.flush()
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from carp.tree_snapshot import take_snapshot
+
+
+StashSize = namedtuple("StashSize", ["bytes", "human"])
+
+
+def humanize_size(size):
+    """Format a size in bytes the same way `du -h' does."""
+    for unit in ["", "K", "M", "G", "T"]:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "P"
+    if unit == "":
+        return str(int(size))
+    if size < 10:
+        return "{:.1f}{}".format(size, unit)
+    return "{:.0f}{}".format(size, unit)
+
+
+class SizeIndex:
+    """
+    Per-directory size index of a file tree.
+
+    Each directory is recorded with its inode, its mtime, the cumulated
+    size of the files it directly contains, the names of its
+    subdirectories and the (size, mtime) of its files. A directory whose
+    (inode, mtime) pair did not move since the last walk is not read
+    again, its files are only checked one by one, as rewriting a file
+    does not change the mtime of its directory.
+    """
+    def __init__(self, index_file, workers=None):
+        self.index_file = index_file
+        self.workers = workers or min(8, (os.cpu_count() or 1) * 2)
+        self.entries = None
+
+    def load(self):
+        self.entries = {}
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            # Corrupted index, it will be rebuilt from scratch.
+            self.entries = {}
+
+    def save(self):
+        # Other carp processes may be saving it at the same time
+        tmp_file = "{}.{}.tmp".format(self.index_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.index_file)
+
+    def scan_dir(self, path):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            return None
+        cached = self.entries.get(path)
+        if cached is not None and len(cached) == 5 \
+           and cached[0] == st.st_ino and cached[1] == st.st_mtime_ns \
+           and self.files_unchanged(path, cached[4]):
+            return cached
+
+        own_size = 0
+        subdirs = []
+        files = {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        else:
+                            file_st = entry.stat(follow_symlinks=False)
+                            own_size += file_st.st_size
+                            files[entry.name] = [file_st.st_size,
+                                                 file_st.st_mtime_ns]
+                    except FileNotFoundError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return [st.st_ino, st.st_mtime_ns, own_size, subdirs, files]
+
+    def files_unchanged(self, path, files):
+        for name, (size, mtime_ns) in files.items():
+            try:
+                st = os.stat(os.path.join(path, name), follow_symlinks=False)
+            except FileNotFoundError:
+                return False
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                return False
+        return True
+
+    def walk(self, root):
+        """Return a {directory: own size} dict for the whole tree."""
+        if self.entries is None:
+            self.load()
+        entries = {}
+        frontier = [root]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while frontier:
+                next_frontier = []
+                for path, data in zip(frontier,
+                                      pool.map(self.scan_dir, frontier)):
+                    if data is None:
+                        continue
+                    entries[path] = data
+                    next_frontier.extend(
+                        os.path.join(path, name) for name in data[3])
+                frontier = next_frontier
+        # Unchanged directories are returned as cached, and vanished
+        # ones are dropped at the same time.
+        changed = len(entries) != len(self.entries) or any(
+            data is not self.entries.get(path)
+            for path, data in entries.items())
+        self.entries = entries
+        if changed:
+            self.save()
+        return {path: data[2] for path, data in entries.items()}
+
+    def compute(self, root):
+        return sum(self.walk(root).values())
+
+    def top_level_sizes(self, root):
+        """
+        Return a {top-level directory name: size} dict from the index as
+        it was last saved, without walking the tree.
+        """
+        if self.entries is None:
+            self.load()
+        root = root.rstrip("/")
+        sizes = {}
+        for path, data in self.entries.items():
+            if not path.startswith(root + "/"):
+                continue
+            top = path[len(root) + 1:].split("/", 1)[0]
+            sizes[top] = sizes.get(top, 0) + data[2]
+        return sizes
+
+
+def read_published_size(state_file):
+    try:
+        with open(state_file, "r") as f:
+            size = json.load(f)["bytes"]
+    except (OSError, ValueError, KeyError):
+        return None
+    return StashSize(size, humanize_size(size))
+
+
+class SizeTracker:
+    """
+    Running byte total of a tree, kept up to date from inotify events.
+
+    The total, as well as the total of each top-level directory, is
+    published in a small JSON state file, which can be read in O(1) by
+    any other process.
+    """
+    def __init__(self, root, state_file, publish_delay=1):
+        self.root = root
+        self.state_file = state_file
+        self.publish_delay = publish_delay
+        self.files = {}
+        self.top_dirs = {}
+        self.total = 0
+        self.dirty = False
+        self.last_publish = 0
+
+    def top_dir(self, path):
+        rel_path = os.path.relpath(path, self.root)
+        if os.sep not in rel_path:
+            # File directly at the root of the tree
+            return "."
+        return rel_path.split(os.sep, 1)[0]
+
+    def _apply(self, path, size):
+        delta = size - self.files.get(path, 0)
+        self.files[path] = size
+        if delta == 0:
+            return
+        self.total += delta
+        top = self.top_dir(path)
+        self.top_dirs[top] = self.top_dirs.get(top, 0) + delta
+        self.dirty = True
+
+    def _walk(self, path):
+        stack = [path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            else:
+                                self._apply(entry.path, entry.stat(
+                                    follow_symlinks=False).st_size)
+                        except FileNotFoundError:
+                            continue
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    def seed_data(self, snapshot=None):
+        """
+        Return the (files, top-level dirs, total) sizes of the tree, as
+        described by the given snapshot, or else by a new one. The
+        tracker itself is left untouched.
+        """
+        if snapshot is None:
+            snapshot = take_snapshot(self.root)
+        files = {}
+        top_dirs = {}
+        total = 0
+        for rel_path, size in snapshot.walk_files():
+            rel_path = os.fsdecode(rel_path)
+            files[os.path.join(self.root, rel_path)] = size
+            top = rel_path.split(os.sep, 1)[0] if os.sep in rel_path \
+                else "."
+            top_dirs[top] = top_dirs.get(top, 0) + size
+            total += size
+        return files, top_dirs, total
+
+    def apply_seed(self, data):
+        (self.files, self.top_dirs, self.total) = data
+        self.publish(True)
+
+    def seed(self, snapshot=None):
+        self.apply_seed(self.seed_data(snapshot))
+
+    def update(self, path):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            self.remove(path)
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            # A whole directory moved in the tree
+            self._walk(path)
+        else:
+            self._apply(path, st.st_size)
+
+    def remove(self, path):
+        if path in self.files:
+            self._apply(path, 0)
+            del self.files[path]
+            return
+        prefix = path.rstrip(os.sep) + os.sep
+        for file_path in [p for p in self.files if p.startswith(prefix)]:
+            self._apply(file_path, 0)
+            del self.files[file_path]
+
+    def publish(self, force=False):
+        now = time.monotonic()
+        if not force and \
+           (not self.dirty or now - self.last_publish < self.publish_delay):
+            return
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"bytes": self.total,
+                       "dirs": self.top_dirs,
+                       "time": time.time()}, f)
+        os.replace(tmp_file, self.state_file)
+        self.dirty = False
+        self.last_publish = now
+
+    def discard(self):
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,104 @@
+import os
+import shlex
+import subprocess
+from xdg.BaseDirectory import get_runtime_dir
+
+
+def is_local_path(remote_path):
+    """Whether rsync sees the given path as a local one."""
+    if remote_path.startswith("rsync://"):
+        return False
+    # Like rsync, a colon before any slash means a remote host
+    return ":" not in remote_path.split("/", 1)[0]
+
+
+def is_daemon_path(remote_path):
+    """Whether the given path is reached through a rsync daemon."""
+    return remote_path.startswith("rsync://") or \
+        "::" in remote_path.split("/", 1)[0]
+
+
+def remote_destination(remote_path):
+    """Return the [user@]host part of a remote path, or None if local."""
+    if is_local_path(remote_path):
+        return None
+    if remote_path.startswith("rsync://"):
+        destination = remote_path[len("rsync://"):].split("/", 1)[0]
+        # Without the daemon port
+        return destination.split(":", 1)[0]
+    return remote_path.split(":", 1)[0]
+
+
+def ssh_destination(remote_path):
+    """
+    Return the [user@]host part of a rsync remote path reached through
+    ssh, or None for local paths and rsync daemons.
+    """
+    if is_daemon_path(remote_path):
+        return None
+    return remote_destination(remote_path)
+
+
+class SSHPool:
+    """
+    Persistent ssh master connections, one per remote destination.
+
+    A master connection is started before the first rsync towards a
+    destination, and the next ones reuse it, from any carp process. It
+    is kept alive persist seconds after its last use, unless it is
+    closed explicitly.
+    """
+    def __init__(self, persist=600, runtime_dir=None):
+        self.persist = persist
+        self.runtime_dir = runtime_dir or os.path.join(
+            get_runtime_dir(strict=False), "carp", "ssh")
+
+    def control_path(self):
+        # ssh replaces %C by a hash of the local host, remote host, port
+        # and user, which keeps the socket path short.
+        return os.path.join(self.runtime_dir, "%C")
+
+    def control_options(self):
+        return ["-o", "ControlPath={}".format(self.control_path())]
+
+    def open(self, destination):
+        check = subprocess.run(
+            ["ssh"] + self.control_options() + ["-O", "check", destination],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if check.returncode == 0:
+            return
+        # Started apart, as a master started by rsync itself would keep
+        # its output pipes open for persist seconds.
+        subprocess.run(
+            ["ssh"] + self.control_options() +
+            ["-o", "ControlMaster=yes",
+             "-o", "ControlPersist={}".format(self.persist),
+             "-N", "-f", destination],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+    def rsh(self, remote_path):
+        """
+        Return the remote shell command rsync must use to go through the
+        master connection, or None if it does not apply.
+        """
+        destination = ssh_destination(remote_path)
+        if self.persist <= 0 or destination is None:
+            return None
+        os.makedirs(self.runtime_dir, mode=0o700, exist_ok=True)
+        self.open(destination)
+        # Without a master, because it could not be started, rsync
+        # simply opens its own connection.
+        return " ".join([
+            "ssh", "-o", "ControlMaster=no",
+            "-o", shlex.quote("ControlPath={}".format(self.control_path()))])
+
+    def close(self, remote_path):
+        destination = ssh_destination(remote_path)
+        if self.persist <= 0 or destination is None:
+            return
+        # The master stops accepting sessions, but only exits once the
+        # running ones, like rsyncs of unmounted stashes, are over.
+        subprocess.run(
+            ["ssh"] + self.control_options() + ["-O", "stop", destination],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -2,11 +2,32 @@ import os
 import re
 import sys
 import time
+import select
 import shutil
 import getpass
+import tempfile
+import threading
 import subprocess
-import inotify.adapters
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from carp.space_usage import SizeIndex, StashSize, humanize_size, \
+    read_published_size
+from carp.supervisor import Supervisor, send_command, MAX_TARGETED_CHANGES
+from carp.sync_journal import SyncJournal
+from carp.activity_log import ActivityLogger
+from carp.activity_store import ActivityStore
+from carp.encfs_names import EncFSNames
+from carp.rsync_progress import run_rsync
+from carp.sync_scheduler import SyncScheduler, FileLock, remote_host, \
+    PRIORITY_UMOUNT, PRIORITY_USER, PRIORITY_DAEMON
+from carp.ssh_pool import SSHPool, ssh_destination, is_local_path
+from carp.local_sync import LocalSync
+from carp.transfer_profile import PROFILES, LARGE_FILES_MODES, \
+    PARTIAL_DIR, auto_profile, rsync_options, shard_partial_dir
+from carp.sync_checkpoint import SyncCheckpoint
+from carp.sync_manifest import MARKER_NAME, DETAIL_NAME, DIRTY_MARKER, \
+    build_manifest, load_manifest, save_manifest, diff_manifests, \
+    write_filter
 from configparser import ConfigParser
 from xdg.BaseDirectory import xdg_config_home
 
@@ -22,6 +43,10 @@ CARP_STASH_POSSIBLE_STATUS = {
     "mounted": _("mounted")
 }
 
+# Editor swap files, lock files and backups
+CARP_DEFAULT_HIDE_FILE_PATTERN = \
+    r"(?:^\.~.+\#|^\.\#|~$|\.lock$|~\.[A-Z0-9]{6}$)"
+
 CARP_POSSIBLE_INOTIFY_STATUS = {
     "IN_CREATE": "created",
     "IN_DELETE": "deleted",
@@ -54,6 +79,46 @@ class CarpMustBePushedError(Exception):
     pass
 
 
+class MountTable:
+    """
+    Cached view of the EncFS mounts living under a given mount point.
+
+    The kernel flags /proc/self/mounts with POLLPRI/POLLERR each time the
+    mount table changes, thus the file is only parsed again when a
+    change has been notified since the last snapshot.
+    """
+    def __init__(self, mount_point):
+        self.matcher = re.compile(
+            r"^encfs {}/(.+?) fuse\.encfs ".format(re.escape(mount_point)),
+            re.MULTILINE
+        )
+        self._proc = open("/proc/self/mounts", "r")
+        self._poller = select.poll()
+        self._poller.register(self._proc, select.POLLPRI | select.POLLERR)
+        self._snapshot = None
+        # The GUI reads it from several threads
+        self._lock = threading.Lock()
+
+    def reset_lock(self):
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def has_changed(self):
+        return any(self._poller.poll(0))
+
+    def snapshot(self):
+        with self._lock:
+            # Always call has_changed, as polling is what acknowledges
+            # the kernel notification.
+            if self.has_changed() or self._snapshot is None:
+                self._proc.seek(0)
+                self._snapshot = frozenset(
+                    self.matcher.findall(self._proc.read()))
+            return self._snapshot
+
+
 class StashManager:
     def __init__(self, config_file):
         self.config_file = config_file
@@ -77,15 +142,34 @@ class StashManager:
         )
         self.config["general"]["encfs_root"] = self.encfs_root
 
+        self.mount_table = MountTable(self.mount_point)
+        self.scheduler = SyncScheduler(
+            self.config["general"].getint("max_syncs", 2))
+        self.ssh_pool = SSHPool(
+            self.config["general"].getint("ssh_control_persist", 600))
+        # Long running processes may ask for buffered activity logs
+        self.log_buffering = False
+        self.activity_loggers = {}
+        self.activity_loggers_lock = threading.Lock()
+
         self.write_config()
         self.reload_stashes()
 
     def reload_stashes(self):
-        self.stashes = {}
+        previous = getattr(self, "stashes", {})
+        stashes = {}
         for sec in self.config.sections():
             if sec == "general":
                 continue
-            self.stashes[sec] = self.init_stash(sec)
+            stashes[sec] = self.init_stash(sec)
+            old = previous.get(sec)
+            if old is not None and all(
+                    old[key] == stashes[sec][key]
+                    for key in ["encfs_root", "config_file", "pass_file"]):
+                # Keep the translated names, which cost an encfsctl run
+                stashes[sec]["names"] = old["names"]
+        # Replaced at once, for the other threads of the GUI
+        self.stashes = stashes
 
     def init_stash(self, stash_name):
         config_dir = self.stash_config_path(stash_name)
@@ -117,11 +201,101 @@ class StashManager:
             raise FileNotFoundError(
                 _("{0} does not exists.").format(stash_encfs_root))
 
+        stash_config = self.config[stash_name]
+        general_config = self.config["general"]
+        sync_quiet_delay = stash_config.getfloat(
+            "sync_quiet_delay", general_config.getfloat("sync_quiet_delay", 5))
+        sync_max_delay = stash_config.getfloat(
+            "sync_max_delay", general_config.getfloat("sync_max_delay", 60))
+        bwlimit = stash_config.getint(
+            "bwlimit", general_config.getint("bwlimit", 0))
+        sync_shards = max(1, stash_config.getint(
+            "sync_shards", general_config.getint("sync_shards", 1)))
+        sync_engine = self.checked_option(
+            stash_name, "sync_engine",
+            stash_config.get("sync_engine",
+                             general_config.get("sync_engine", "auto")),
+            ["auto", "rsync", "native"], "auto")
+        transfer_profile = self.checked_option(
+            stash_name, "transfer_profile",
+            stash_config.get("transfer_profile",
+                             general_config.get("transfer_profile",
+                                                "standard")),
+            ["auto"] + list(PROFILES), "standard")
+        resume_transfers = stash_config.getboolean(
+            "resume_transfers",
+            general_config.getboolean("resume_transfers", True))
+        # Settings given on their own override the ones of the profile
+        transfer_settings = {}
+        for option, getter in [("large_files", "get"),
+                               ("compress", "getboolean"),
+                               ("whole_file", "getboolean"),
+                               ("checksum", "getboolean"),
+                               ("block_size", "getint")]:
+            value = getattr(stash_config, getter)(
+                "rsync_" + option,
+                getattr(general_config, getter)("rsync_" + option))
+            if value is not None:
+                transfer_settings[option] = value
+        if self.checked_option(
+                stash_name, "rsync_large_files",
+                transfer_settings.get("large_files", "none"),
+                LARGE_FILES_MODES, None) is None:
+            # The mode of the profile is kept
+            del transfer_settings["large_files"]
+        watch_encrypted = stash_config.getboolean(
+            "watch_encrypted",
+            general_config.getboolean("watch_encrypted", False))
+        ignore_patterns = [general_config.get(
+            "hide_file_pattern", CARP_DEFAULT_HIDE_FILE_PATTERN)]
+        ignore_patterns += [
+            pattern.strip() for pattern
+            in stash_config.get("exclude", "").split("\n")
+            if pattern.strip() != ""]
+        ignore_re = re.compile("|".join(
+            "(?:{})".format(pattern) for pattern in ignore_patterns))
+
         return {"config_path": config_dir,
                 "config_file": config_file,
                 "pass_file": pass_file,
                 "remote_path": stash_remote_path,
-                "encfs_root": stash_encfs_root}
+                "encfs_root": stash_encfs_root,
+                "names": EncFSNames(stash_encfs_root, config_file, pass_file),
+                "size_index": SizeIndex(
+                    os.path.join(config_dir, "size_index.json")),
+                "usage_file": os.path.join(config_dir, "usage.json"),
+                "journal_file": os.path.join(config_dir, "sync.journal"),
+                "sync_lock": os.path.join(config_dir, "sync.lock"),
+                "manifest_file": os.path.join(config_dir,
+                                              "manifest.json.gz"),
+                "snapshot_file": os.path.join(config_dir, "tree.snapshot"),
+                "activity_db": os.path.join(config_dir, "activity.db"),
+                "sync_quiet_delay": sync_quiet_delay,
+                "sync_max_delay": sync_max_delay,
+                "bwlimit": bwlimit,
+                "sync_engine": sync_engine,
+                "sync_shards": sync_shards,
+                "transfer_profile": transfer_profile,
+                "transfer_settings": transfer_settings,
+                "resume_transfers": resume_transfers,
+                "partial_dir": os.path.join(config_dir, "partial"),
+                "checkpoint": SyncCheckpoint(
+                    os.path.join(config_dir, "checkpoint.json")),
+                "watch_encrypted": watch_encrypted,
+                "ignore_re": ignore_re}
+
+    def checked_option(self, stash_name, option, value, choices, default):
+        # A typo in one stash must not prevent working on the others
+        if value in choices:
+            return value
+        if default is None:
+            print(_("WARNING: {0}: unknown {1} {2}, ignored")
+                  .format(stash_name, option, value), file=sys.stderr)
+        else:
+            print(_("WARNING: {0}: unknown {1} {2}, {3} is used instead")
+                  .format(stash_name, option, value, default),
+                  file=sys.stderr)
+        return default
 
     def stash_config_path(self, stash_name):
         default = os.path.join(xdg_config_home, "carp", stash_name)
@@ -150,22 +324,39 @@ class StashManager:
         return path
 
     def write_config(self):
-        with open(self.config_file, "w") as f:
+        # Other carp processes may be reading it at the same time
+        tmp_file = "{}.{}.tmp".format(self.config_file, os.getpid())
+        with open(tmp_file, "w") as f:
             self.config.write(f)
-
-    def log_activity(self, stash_name, activity):
-        config_dir = self.stashes[stash_name]["config_path"]
-        log_file = os.path.join(config_dir, "activity.log")
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(log_file, "a") as f:
-            f.write("[{0}] {1}\n".format(now, activity))
-
-        rotate_file = False
-        if sum(1 for _line in open(log_file, "r")) > 500:
-            rotate_file = True
-        if rotate_file:
-            shutil.copyfile(log_file, log_file + ".1")
-            os.truncate(log_file, 0)
+        os.replace(tmp_file, self.config_file)
+
+    def activity_logger(self, stash_name):
+        with self.activity_loggers_lock:
+            if stash_name not in self.activity_loggers:
+                general_config = self.config["general"]
+                self.activity_loggers[stash_name] = ActivityLogger(
+                    os.path.join(self.stashes[stash_name]["config_path"],
+                                 "activity.log"),
+                    general_config.getint("log_max_size", 256 * 1024),
+                    general_config.getint("log_generations", 3),
+                    general_config.getboolean("log_compress", False),
+                    ActivityStore(self.stashes[stash_name]["activity_db"],
+                                  general_config.getint(
+                                      "activity_max_entries", 100000)))
+            return self.activity_loggers[stash_name]
+
+    def log_activity(self, stash_name, activity, path=None, status=None):
+        logger = self.activity_logger(stash_name)
+        logger.log(activity, path, status)
+        if not self.log_buffering:
+            logger.flush()
+
+    def flush_activity_logs(self, force=False):
+        for logger in list(self.activity_loggers.values()):
+            if force:
+                logger.flush()
+            else:
+                logger.maybe_flush()
 
     def valid_stash(self, stash_name):
         if stash_name not in self.stashes.keys():
@@ -173,30 +364,49 @@ class StashManager:
                                      .format(stash_name))
 
     def mounted_stashes(self):
-        all_stashes = self.stashes.keys()
-        _mounted_stashes = []
-        with open("/proc/mounts", "r") as proc:
-            for line in proc:
-                regex = r"^encfs {}/(.+) fuse.encfs.+$" \
-                        .format(self.mount_point)
-                cdata = re.match(regex, line)
-                if cdata is None:
-                    continue
-                lst = cdata.group(1)
-                if lst not in all_stashes:
-                    continue
-                _mounted_stashes.append(lst)
-        return _mounted_stashes
+        mounted = self.mount_table.snapshot()
+        return [st for st in self.stashes.keys() if st in mounted]
 
-    def unmounted_stashes(self):
+    def unmounted_stashes(self, mounted_stashes=None):
+        if mounted_stashes is None:
+            mounted_stashes = self.mounted_stashes()
         return [st for st in self.stashes.keys()
-                if st not in self.mounted_stashes()]
+                if st not in mounted_stashes]
+
+    def stash_size(self, stash_name, mounted=None):
+        stash = self.stashes[stash_name]
+        if mounted is None:
+            mounted = stash_name in self.mounted_stashes()
+        if mounted:
+            # The sync daemon publishes the current usage of the stash
+            published = read_published_size(stash["usage_file"])
+            if published is not None:
+                return published
+        size = stash["size_index"].compute(stash["encfs_root"])
+        return StashSize(size, humanize_size(size))
+
+    def file_space_usage(self, stash_name, mounted=None):
+        return self.stash_size(stash_name, mounted).human
+
+    def plaintext_paths(self, stash_name, paths):
+        """
+        Translate the given absolute paths, living under the stash
+        encrypted root, to their counterparts under its mount point.
 
-    def file_space_usage(self, stash_name):
-        encfs_mp = self.stashes[stash_name]["encfs_root"]
-        cmd = subprocess.run(["du", "-sh", encfs_mp],
-                             check=True, stdout=subprocess.PIPE)
-        return re.sub(encfs_mp, "", cmd.stdout.decode()).strip()
+        Paths which cannot be translated are returned untouched.
+        """
+        encfs_root = self.stashes[stash_name]["encfs_root"].rstrip("/") + "/"
+        cipher_paths = [p[len(encfs_root):] for p in paths
+                        if p.startswith(encfs_root)]
+        if not cipher_paths:
+            return paths
+        decoded = self.stashes[stash_name]["names"].decode(cipher_paths)
+        if decoded is None:
+            return paths
+        decoded = dict(zip(cipher_paths, decoded))
+        stash_mount_point = os.path.join(self.mount_point, stash_name)
+        return [os.path.join(stash_mount_point, decoded[p[len(encfs_root):]])
+                if p.startswith(encfs_root) else p for p in paths]
 
     def _format_stash(self, stash_name, state="mounted", no_state=False):
         pdata = [stash_name]
@@ -314,7 +524,7 @@ class StashManager:
             state = "mounted"
 
         loc_mounted = self.mounted_stashes()
-        loc_unmounted = self.unmounted_stashes()
+        loc_unmounted = self.unmounted_stashes(loc_mounted)
         has_mounted = any(loc_mounted)
         has_unmounted = any(loc_unmounted)
 
@@ -332,6 +542,50 @@ class StashManager:
 
         return self._list_fancy(state, loc_mounted, loc_unmounted)
 
+    def activity_path_prefix(self, stash_name, path):
+        stash = self.stashes[stash_name]
+        if os.path.isabs(path):
+            return path
+        if not stash["watch_encrypted"]:
+            return os.path.join(self.mount_point, stash_name, path)
+        # Stored paths are ciphertext ones
+        encoded = stash["names"].encode([path.strip("/")])
+        if encoded is None:
+            raise CarpSubcommandError(
+                _("Unable to encode {0} without a saved password.")
+                .format(path))
+        return os.path.join(stash["encfs_root"], encoded[0])
+
+    def activity(self, opts):
+        stash_name = opts["stash"]
+        self.valid_stash(stash_name)
+        db_file = self.stashes[stash_name]["activity_db"]
+        if not os.path.exists(db_file):
+            return True
+
+        path_prefix = None
+        if opts.get("path"):
+            path_prefix = self.activity_path_prefix(stash_name, opts["path"])
+
+        store = ActivityStore(db_file)
+        try:
+            entries = store.query(opts.get("since"), path_prefix,
+                                  opts.get("limit"),
+                                  changes_only=opts.get("changes_only", False))
+        finally:
+            store.close()
+
+        paths = self.plaintext_paths(
+            stash_name, [e[1] for e in entries if e[1] is not None])
+        paths.reverse()
+        for (when, path, status, message) in entries:
+            if path is not None:
+                message = "{} {}".format(paths.pop(), status)
+            print("[{0}] {1}".format(
+                datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S"),
+                message))
+        return True
+
     def create(self, opts):
         stash_encfs_root = self.check_and_clean_dir_path(
             opts["rootdir"], True
@@ -394,7 +648,15 @@ class StashManager:
             return False
         return not self.stashes[stash_name].get("nosync", False)
 
-    def handle_inotify_event(self, event, stash_name):
+    def is_ignored(self, stash_name, filename):
+        stash = self.stashes[stash_name]
+        if stash["watch_encrypted"]:
+            # Ciphertext names cannot be matched
+            return False
+        return stash["ignore_re"].search(
+            os.path.basename(filename)) is not None
+
+    def handle_inotify_event(self, event, stash_name, size_tracker=None):
         (_data, type_names, watch_path, filename) = event
 
         main_activity = None
@@ -412,49 +674,30 @@ class StashManager:
         else:
             return 2
 
-        message = "{} {}".format(
-            os.path.join(watch_path, filename),
-            CARP_POSSIBLE_INOTIFY_STATUS[main_activity]
-        )
-        self.log_activity(stash_name, message)
-        return 1
-
-    def inotify_push_stash(self, stash_name):
-        cmd = subprocess.run(["pgrep", "-u", getpass.getuser(), "rsync"],
-                             stdout=subprocess.DEVNULL)
-        if cmd.returncode == 0:
-            self.log_activity(stash_name, "Sync already running")
-            return True
-
-        self.log_activity(stash_name, "Will sync NOW")
-        self.push({"stash": stash_name, "test": False, "quiet": True})
-        return False
-
-    def inotify_loop(self, stash_name, stash_mount_point):
-        i = inotify.adapters.InotifyTree(stash_mount_point)
-
-        must_sync = False
-        sync_wait = 10
-
-        # And see the corresponding events:
-        for event in i.event_gen(terminal_events=('IN_Q_OVERFLOW')):
-            if sync_wait == 0:
-                sync_wait = 10
-                if must_sync:
-                    must_sync = self.inotify_push_stash(stash_name)
+        event_path = os.path.join(watch_path, filename)
+        if size_tracker is not None:
+            if main_activity == "IN_DELETE" or "IN_MOVED_FROM" in type_names:
+                size_tracker.remove(event_path)
             else:
-                sync_wait -= 1
+                size_tracker.update(event_path)
 
-            if event is None:
-                continue
+        if filename != "" and self.is_ignored(stash_name, filename):
+            # Still counted in the stash size, but never synced
+            return 2
 
-            must_continue = self.handle_inotify_event(event, stash_name)
-            if must_continue == 0:
-                break
-            elif must_continue == 1:
-                must_sync = True
+        status = CARP_POSSIBLE_INOTIFY_STATUS[main_activity]
+        message = "{} {}".format(event_path, status)
+        self.log_activity(stash_name, message, event_path, status)
+        return 1
 
-        self.log_activity(stash_name, "Killing inotify daemon")
+    def inotify_push_stash(self, stash_name, changed_paths=None,
+                           encoded_paths=False):
+        self.log_activity(stash_name, "Will sync NOW")
+        # Keep the stash dirty if the push failed
+        return not self.push({"stash": stash_name, "test": False,
+                              "quiet": True, "changed_paths": changed_paths,
+                              "encoded_paths": encoded_paths,
+                              "priority": PRIORITY_DAEMON})
 
     def daemonize(self):
         """
@@ -465,6 +708,8 @@ class StashManager:
         """
         newpid = os.fork()
         if newpid > 0:
+            # Reap the intermediate child
+            os.waitpid(newpid, 0)
             return False
         # decouple from parent environment
         os.chdir("/")
@@ -473,9 +718,46 @@ class StashManager:
         # Fork a second time
         newpid = os.fork()
         if newpid > 0:
-            return False
+            os._exit(0)
+        # Only this thread survived the forks. Locks held by the other
+        # threads of the GUI would never be released.
+        self.mount_table.reset_lock()
+        self.activity_loggers_lock = threading.Lock()
+        # SQLite connections cannot be used across fork(), the child
+        # opens its own. The inherited ones are not even closed, which
+        # could drop the WAL file still used by the parent.
+        self.inherited_loggers = self.activity_loggers
+        self.activity_loggers = {}
+        # Don't keep the caller terminal or pipes open
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+        os.close(devnull)
         return True
 
+    def supervisor_command(self, command, **kwargs):
+        try:
+            return send_command(command, **kwargs)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if command != "register":
+                # Nothing to do if no supervisor is running.
+                return None
+
+        if self.daemonize():
+            # Child process, become the sync supervisor
+            try:
+                Supervisor(self).serve()
+            finally:
+                os._exit(0)
+
+        for _i in range(50):
+            time.sleep(0.1)
+            try:
+                return send_command(command, **kwargs)
+            except (FileNotFoundError, ConnectionRefusedError):
+                continue
+        raise CarpSubcommandError(_("Unable to reach the sync supervisor"))
+
     def mount(self, opts):
         test_run = opts.get("test", False)
         stash_name = opts["stash"]
@@ -492,7 +774,9 @@ class StashManager:
         )
         stash_encfs_root = self.stashes[stash_name]["encfs_root"]
 
-        os.environ["ENCFS6_CONFIG"] = self.stashes[stash_name]["config_file"]
+        # Not in os.environ, as several stashes may be mounted at once
+        mount_env = dict(os.environ,
+                         ENCFS6_CONFIG=self.stashes[stash_name]["config_file"])
         if test_run:
             print(_("{0} should be mounted without problem (DRY RUN)")
                   .format(stash_mount_point))
@@ -508,7 +792,8 @@ class StashManager:
             mount_cmd.insert(1, "--extpass")
             mount_cmd.insert(2, opts["pass_cmd"])
 
-        success_mount = subprocess.run(mount_cmd).returncode
+        success_mount = subprocess.run(mount_cmd, env=mount_env).returncode
+        self.mount_table.invalidate()
 
         if success_mount != 0:
             print("{0} NOT mounted".format(stash_mount_point))
@@ -520,10 +805,12 @@ class StashManager:
             # If we don't have to sync, quit early
             return True
 
-        if self.daemonize():
-            # Child process, begin loop
-            self.inotify_loop(stash_name, stash_mount_point)
-
+        answer = self.supervisor_command("register", stash=stash_name,
+                                         mount_point=stash_mount_point)
+        if answer.get("status") != "ok":
+            print(_("WARNING: {0} will not be automatically synced: {1}")
+                  .format(stash_name, answer.get("message")),
+                  file=sys.stderr)
         return True
 
     def umount(self, opts):
@@ -542,8 +829,11 @@ class StashManager:
                   .format(stash_mount_point))
             return True
 
+        answer = self.supervisor_command("unregister", stash=stash_name)
+        watched = answer is not None and answer.get("watched", False)
         cmd = subprocess.run(
             ["fusermount", "-u", stash_mount_point])
+        self.mount_table.invalidate()
 
         if cmd.returncode != 0:
             print(_("ERROR: Something strange happened with fusermount."
@@ -555,9 +845,53 @@ class StashManager:
 
         if self.may_sync(stash_name):
             self.log_activity(stash_name, "Will sync NOW")
-            self.push({"stash": stash_name, "test": False})
+            # Changes of a watched stash are all in its sync journal
+            self.push_journal(stash_name, watched, opts.get("progress"),
+                              PRIORITY_UMOUNT)
+            self.release_remote(stash_name)
         return True
 
+    def release_remote(self, stash_name):
+        """
+        Stop the ssh master connection of the stash remote, unless
+        another mounted stash still uses it.
+        """
+        destination = ssh_destination(
+            self.stashes[stash_name]["remote_path"])
+        if destination is None:
+            return
+        for st in self.mounted_stashes():
+            if st == stash_name or not self.may_sync(st):
+                continue
+            if ssh_destination(self.stashes[st]["remote_path"]) == \
+               destination:
+                return
+        self.ssh_pool.close(self.stashes[stash_name]["remote_path"])
+
+    def push_journal(self, stash_name, outstanding_only=True,
+                     progress=None, priority=PRIORITY_USER):
+        stash = self.stashes[stash_name]
+        journal = SyncJournal(stash["journal_file"])
+        try:
+            if outstanding_only and not journal.dirty():
+                return True
+            seq = journal.seq
+            changed_paths = None
+            if outstanding_only:
+                path_kind = "C" if stash["watch_encrypted"] else "P"
+                changed_paths = journal.changes(path_kind,
+                                                MAX_TARGETED_CHANGES)
+            success = self.push({"stash": stash_name, "test": False,
+                                 "changed_paths": changed_paths,
+                                 "encoded_paths": stash["watch_encrypted"],
+                                 "progress": progress,
+                                 "priority": priority})
+            if success:
+                journal.acknowledge(seq)
+            return success
+        finally:
+            journal.close()
+
     def rsync(self, opts, direction="pull"):
         stash_name = opts["stash"]
         self.valid_stash(stash_name)
@@ -569,19 +903,136 @@ class StashManager:
             raise CarpNoRemoteError(_("No remote configured for {0}")
                                     .format(stash_name))
 
+        # Only one sync at a time for a given stash
+        stash_lock = FileLock(self.stashes[stash_name]["sync_lock"])
+        if not stash_lock.acquire(blocking=False):
+            if opts.get("quiet") is not True:
+                print(_("Waiting for the running sync of {0}")
+                      .format(stash_name))
+            stash_lock.acquire()
+        try:
+            return self.locked_rsync(opts, direction)
+        finally:
+            stash_lock.release()
+
+    def fetch_remote_manifest(self, rsync_base, remote_path, name,
+                              tmp_dir):
+        target = os.path.join(tmp_dir, name)
+        if is_local_path(remote_path):
+            # Local remote, no need for rsync
+            if not os.path.exists(remote_path + name):
+                return None
+            shutil.copyfile(remote_path + name, target)
+            return target
+        cmd = subprocess.run(rsync_base + ["-q", remote_path + name, target],
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
+        if cmd.returncode != 0:
+            # No manifest yet
+            return None
+        return target
+
+    def publish_manifest(self, rsync_base, remote_path, manifest):
+        """
+        Write the given manifest next to the remote stash. A None
+        manifest marks the remote as changed in an unknown way.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files = [os.path.join(tmp_dir, MARKER_NAME)]
+            with open(files[0], "w") as f:
+                f.write(manifest["digest"] if manifest else DIRTY_MARKER)
+            if manifest is not None:
+                files.append(os.path.join(tmp_dir, DETAIL_NAME))
+                save_manifest(manifest, files[1])
+            if is_local_path(remote_path):
+                if not os.path.isdir(remote_path):
+                    return False
+                for path in files:
+                    target = os.path.join(remote_path,
+                                          os.path.basename(path))
+                    # Named like the manifest, thus never synced
+                    os.replace(shutil.copy(path, target + ".tmp"), target)
+                return True
+            cmd = subprocess.run(rsync_base + ["-q"] + files + [remote_path],
+                                 stdout=subprocess.DEVNULL)
+        return cmd.returncode == 0
+
+    def plan_sync(self, stash_name, direction, rsync_base, remote_path,
+                  local):
+        """
+        Return the directories which differ between the local tree and
+        the remote one, or None if the whole tree must be synced, and
+        the remote manifest if known.
+        """
+        last = load_manifest(self.stashes[stash_name]["manifest_file"])
+        remote = None
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            marker = self.fetch_remote_manifest(
+                rsync_base, remote_path, MARKER_NAME, tmp_dir)
+            remote_digest = None
+            if marker is not None:
+                with open(marker, "r") as f:
+                    remote_digest = f.read().strip()
+            if last is not None and remote_digest == last["digest"]:
+                # Nobody pushed since our last sync
+                remote = last
+            elif direction == "pull" and \
+                    remote_digest not in [None, DIRTY_MARKER]:
+                detail = self.fetch_remote_manifest(
+                    rsync_base, remote_path, DETAIL_NAME, tmp_dir)
+                if detail is not None:
+                    remote = load_manifest(detail)
+                if remote is not None and remote["digest"] != remote_digest:
+                    remote = None
+        if direction == "push":
+            return diff_manifests(local, remote), remote
+        return diff_manifests(remote, local), remote
+
+    def locked_rsync(self, opts, direction):
+        stash_name = opts["stash"]
+        stash = self.stashes[stash_name]
+        test_run = opts.get("test", False)
         av_opt = "-av"
-        if "test" in opts and opts["test"]:
+        if test_run:
             av_opt = "-nav"
 
-        stash_encfs_root = self.stashes[stash_name]["encfs_root"]
+        stash_encfs_root = stash["encfs_root"]
         if stash_encfs_root[-1:] != "/":
             stash_encfs_root += "/"
 
-        stash_remote_path = self.stashes[stash_name]["remote_path"]
+        stash_remote_path = stash["remote_path"]
         if stash_remote_path[-1:] != "/":
             stash_remote_path += "/"
 
-        rsync_cmd = ["rsync", av_opt, "--delete"]
+        rsync_base = ["rsync"]
+        rsh = self.ssh_pool.rsh(stash_remote_path)
+        if rsh is not None:
+            rsync_base.append("--rsh={}".format(rsh))
+
+        transfer_opts = [av_opt] + self.transfer_options(stash_name,
+                                                         direction)
+        # The manifest files only live on the remote side
+        rsync_cmd = rsync_base + transfer_opts + [
+            "--delete", "--exclude=/{}*".format(MARKER_NAME)]
+        changed_paths = None
+        if direction == "push":
+            changed_paths = opts.get("changed_paths")
+        if changed_paths is not None and \
+           not opts.get("encoded_paths", False):
+            # May still be None if ciphertext names are not available
+            changed_paths = stash["names"].encode(changed_paths)
+        if changed_paths is not None:
+            if not changed_paths:
+                return True
+            # Only transfer the given paths. The ones which do not
+            # exist anymore locally are deleted on the remote side.
+            files_from = os.path.join(stash["config_path"], "push.list")
+            with open(files_from, "wb") as f:
+                f.write(b"\0".join(os.fsencode(p) for p in changed_paths))
+            rsync_cmd = rsync_base + transfer_opts + [
+                "-r", "--from0", "--files-from={}".format(files_from),
+                "--delete-missing-args"]
+
         if direction == "push":
             rsync_cmd.append(stash_encfs_root)
             rsync_cmd.append(stash_remote_path)
@@ -590,15 +1041,228 @@ class StashManager:
             rsync_cmd.append(stash_remote_path)
             rsync_cmd.append(stash_encfs_root)
 
-        if "quiet" in opts and opts["quiet"] is True:
+        quiet = opts.get("quiet") is True
+        if quiet:
             rsync_cmd.insert(1, "-q")
-        else:
-            print(" ".join(rsync_cmd))
 
-        cmd = subprocess.run(rsync_cmd)
-        if cmd.returncode != 0:
-            return False
-        return True
+        host = remote_host(stash_remote_path)
+        slot = self.scheduler.acquire(opts.get("priority", PRIORITY_USER),
+                                      host)
+        try:
+            local = None
+            changed_dirs = None
+            use_manifest = not test_run and changed_paths is None
+            if use_manifest:
+                local = build_manifest(stash_encfs_root)
+                (changed_dirs, remote) = self.plan_sync(
+                    stash_name, direction, rsync_base, stash_remote_path,
+                    local)
+                if changed_dirs == []:
+                    if not quiet:
+                        print(_("{0} is already up to date")
+                              .format(stash_name))
+                    return True
+                if changed_dirs is not None:
+                    # Only sync the directories which differ
+                    filter_file = os.path.join(stash["config_path"],
+                                               "sync.filter")
+                    write_filter(changed_dirs, filter_file)
+                    rsync_cmd.insert(-2, "--filter=merge {}".format(
+                        filter_file))
+            if direction == "push" and not test_run and \
+               (use_manifest or os.path.exists(stash["manifest_file"])):
+                # Other hosts must not trust the remote manifest while
+                # it is being changed.
+                self.publish_manifest(rsync_base, stash_remote_path, None)
+                if not use_manifest:
+                    os.remove(stash["manifest_file"])
+
+            if self.use_native_engine(stash_name):
+                returncode = self.native_sync(opts, direction, changed_paths,
+                                              changed_dirs)
+            else:
+                shards = []
+                if not test_run and changed_paths is None and \
+                   changed_dirs is None:
+                    shards = self.plan_shards(stash_name)
+                bwlimit = stash["bwlimit"]
+                if bwlimit > 0:
+                    # Shared with the other syncs towards the same host
+                    running = self.scheduler.running_towards(host, slot)
+                    rsync_cmd.insert(1, "--bwlimit={}".format(
+                        max(1, bwlimit // running)))
+                stats = None
+                if not test_run:
+                    resumed = stash["checkpoint"].begin(direction,
+                                                        stash["remote_path"])
+                    # Whole files are sent again from scratch, nothing
+                    # is ever resumed.
+                    if resumed is not None and \
+                       "--whole-file" not in rsync_cmd:
+                        stats = {}
+                        if not quiet:
+                            print(_("Resuming the interrupted {0} of {1}")
+                                  .format(direction, stash_name))
+                returncode = 0
+                if shards:
+                    returncode = self.sharded_rsync(rsync_cmd, shards,
+                                                    quiet, stats)
+                    rsync_cmd = [shard_partial_dir(arg, "all")
+                                 for arg in rsync_cmd]
+                # The final pass goes over the whole stash again, files
+                # partially transferred or vanished included.
+                if returncode in [0, 23, 24]:
+                    if not quiet:
+                        print(" ".join(rsync_cmd))
+                    returncode = run_rsync(rsync_cmd, opts.get("progress"),
+                                           stats)
+                if returncode == 0 and not test_run:
+                    self.end_checkpoint(stash_name, direction, stats, quiet)
+
+            if returncode == 0 and use_manifest:
+                self.record_manifest(stash_name, direction, rsync_base,
+                                     local, remote)
+        finally:
+            slot.release()
+        return returncode == 0
+
+    def transfer_options(self, stash_name, direction):
+        stash = self.stashes[stash_name]
+        profile = stash["transfer_profile"]
+        if profile == "auto":
+            profile = auto_profile(stash["remote_path"],
+                                   load_manifest(stash["manifest_file"]))
+        settings = dict(PROFILES[profile])
+        settings.update(stash["transfer_settings"])
+        if stash["resume_transfers"]:
+            settings.setdefault("large_files", "partial")
+        partial_dir = PARTIAL_DIR
+        if direction == "pull":
+            # Kept out of the encrypted root, where EncFS could not make
+            # sense of them.
+            partial_dir = stash["partial_dir"]
+            os.makedirs(partial_dir, exist_ok=True)
+        return rsync_options(settings, partial_dir)
+
+    def plan_shards(self, stash_name):
+        """
+        Split the top-level entries of a stash into balanced groups, one
+        per shard, using the size index. Return [] if not worth it.
+        """
+        stash = self.stashes[stash_name]
+        if stash["sync_shards"] < 2:
+            return []
+        sizes = stash["size_index"].top_level_sizes(stash["encfs_root"])
+        entries = []
+        with os.scandir(stash["encfs_root"]) as it:
+            for entry in it:
+                if entry.name.startswith(MARKER_NAME):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    size = sizes.get(entry.name, 0)
+                else:
+                    size = entry.stat(follow_symlinks=False).st_size
+                entries.append((size, entry.name))
+        shards = [[0, []] for _ in range(
+            min(stash["sync_shards"], len(entries)))]
+        # Biggest entries first, each one to the lightest shard
+        for size, name in sorted(entries, reverse=True):
+            lightest = min(shards, key=lambda s: s[0])
+            lightest[0] += size
+            lightest[1].append(name)
+        if len(shards) < 2:
+            return []
+        return [names for _size, names in shards]
+
+    def end_checkpoint(self, stash_name, direction, stats, quiet):
+        stash = self.stashes[stash_name]
+        stash["checkpoint"].end(direction)
+        if direction == "pull":
+            # Partial files of transfers which were not resumed
+            shutil.rmtree(stash["partial_dir"], ignore_errors=True)
+        if stats is None or quiet:
+            return
+        # Matched data was found in the partial files, but also in the
+        # previous versions of every updated file. Literal data was sent.
+        print(_("{0} reused, {1} transferred").format(
+            humanize_size(stats.get("Matched data", 0)),
+            humanize_size(stats.get("Literal data", 0))))
+
+    def sharded_rsync(self, rsync_cmd, shards, quiet, stats=None):
+        """
+        Run one rsync per shard at once, each on its own top-level
+        entries. Deletions are left to the final pass over the whole
+        stash, which then has little left to transfer.
+
+        Shards are planned from the local entries, which may be missing
+        on the remote side when pulling: they are then ignored, and the
+        final pass fetches the remote entries missing locally.
+        """
+        (source, destination) = rsync_cmd[-2:]
+        base = []
+        for arg in rsync_cmd[:-2]:
+            if arg == "--delete":
+                continue
+            if arg.startswith("--bwlimit="):
+                # Shared between the shards
+                arg = "--bwlimit={}".format(max(
+                    1, int(arg.split("=", 1)[1]) // len(shards)))
+            base.append(arg)
+        commands = [[shard_partial_dir(arg, str(index)) for arg in base] +
+                    ["--relative", "--ignore-missing-args"] +
+                    [source + "./" + name for name in names] +
+                    [destination] for index, names in enumerate(shards)]
+        if not quiet:
+            for command in commands:
+                print(" ".join(command))
+        shard_stats = [None if stats is None else {} for _ in commands]
+        with ThreadPoolExecutor(max_workers=len(commands)) as pool:
+            returncodes = list(pool.map(run_rsync, commands,
+                                        [None] * len(commands),
+                                        shard_stats))
+        if stats is not None:
+            for one_stats in shard_stats:
+                for name, value in one_stats.items():
+                    stats[name] = stats.get(name, 0) + value
+        return next((code for code in returncodes if code != 0), 0)
+
+    def record_manifest(self, stash_name, direction, rsync_base, local,
+                        remote):
+        stash = self.stashes[stash_name]
+        if direction == "pull":
+            local = build_manifest(stash["encfs_root"])
+        save_manifest(local, stash["manifest_file"])
+        if direction == "push" or remote is None:
+            self.publish_manifest(rsync_base,
+                                  stash["remote_path"].rstrip("/") + "/",
+                                  local)
+
+    def native_sync(self, opts, direction, changed_paths, changed_dirs):
+        stash = self.stashes[opts["stash"]]
+        quiet = opts.get("quiet") is True
+        if direction == "push":
+            source = stash["encfs_root"]
+            destination = stash["remote_path"]
+        else:
+            source = stash["remote_path"]
+            destination = stash["encfs_root"]
+        if not quiet:
+            print(_("Syncing {0} to {1}").format(source, destination))
+        sync = LocalSync(source, destination,
+                         dry_run=opts.get("test", False),
+                         verbose=not quiet,
+                         progress=opts.get("progress"),
+                         root_exclude=MARKER_NAME)
+        errors = sync.run(paths=changed_paths, only_dirs=changed_dirs)
+        # Same exit code as rsync for a partial transfer
+        return 0 if errors == 0 else 23
+
+    def use_native_engine(self, stash_name):
+        engine = self.stashes[stash_name]["sync_engine"]
+        if engine == "auto":
+            # rsync is still better at talking to remote hosts
+            return is_local_path(self.stashes[stash_name]["remote_path"])
+        return engine == "native"
 
     def pull(self, opts):
         return self.rsync(opts)
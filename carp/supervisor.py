@@ -0,0 +1,624 @@
+import os
+import json
+import time
+import select
+import functools
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from carp.watcher import Watcher
+from carp.space_usage import SizeTracker
+from carp.sync_journal import SyncJournal
+from carp.sync_scheduler import FileLock
+from carp.tree_snapshot import TreeSnapshot, take_snapshot, diff_snapshots
+from xdg.BaseDirectory import get_runtime_dir
+
+# Seconds a client may take to send its command or read the answer
+CLIENT_TIMEOUT = 2
+
+# Above this number of changed paths, a full push is cheaper than
+# translating and listing every one of them.
+MAX_TARGETED_CHANGES = 5000
+
+
+def supervisor_socket_path():
+    return os.path.join(get_runtime_dir(strict=False), "carp",
+                        "supervisor.sock")
+
+
+def send_command(command, **kwargs):
+    """
+    Send a command to the running supervisor and return its answer.
+
+    Raise FileNotFoundError or ConnectionRefusedError when no supervisor
+    is listening.
+    """
+    kwargs["command"] = command
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(supervisor_socket_path())
+        sock.sendall((json.dumps(kwargs) + "\n").encode())
+        with sock.makefile("r") as answer:
+            return json.loads(answer.readline() or "{}")
+
+
+class Debouncer:
+    """
+    Decide when a changed stash must be pushed.
+
+    A push is due once no change happened for quiet_delay seconds, or at
+    the latest max_delay seconds after the first unsynced change. After
+    failed pushes, the next one waits twice longer each time, up to
+    max_delay, until one succeeds.
+    """
+    def __init__(self, quiet_delay, max_delay):
+        self.quiet_delay = quiet_delay
+        self.max_delay = max(max_delay, quiet_delay)
+        self.failures = 0
+        self.retry_at = None
+        self.reset()
+
+    def reset(self):
+        self.first_change = None
+        self.last_change = None
+
+    def touch(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+
+    def failed(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.failures += 1
+        self.retry_at = now + min(self.quiet_delay * 2 ** self.failures,
+                                  self.max_delay)
+        self.touch(now)
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = None
+
+    def pending(self):
+        return self.first_change is not None
+
+    def deadline(self):
+        if self.first_change is None:
+            return None
+        deadline = min(self.last_change + self.quiet_delay,
+                       self.first_change + self.max_delay)
+        if self.retry_at is not None:
+            deadline = max(deadline, self.retry_at)
+        return deadline
+
+    def due(self, now=None):
+        if self.first_change is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now >= self.deadline()
+
+
+class EventCoalescer:
+    """
+    Fold the inotify events of a same path happening within window
+    seconds into one net change.
+
+    For exemple, a creation followed by a deletion results in nothing,
+    and several modifications result in only one. Net changes are
+    returned as events with synthetic type names, thus they can be
+    handled as raw ones.
+    """
+    appearing = ("IN_CREATE", "IN_MOVED_TO")
+    vanishing = ("IN_DELETE", "IN_MOVED_FROM")
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+
+    def main_type(self, type_names):
+        for type_name in self.appearing + self.vanishing + \
+                ("IN_MODIFY", "IN_CLOSE_WRITE"):
+            if type_name in type_names:
+                return type_name
+        return None
+
+    def add(self, stash_name, event):
+        """
+        Record the given event. Return False if it cannot be coalesced
+        and must be handled right away.
+        """
+        (header, type_names, watch_path, filename) = event
+        main_type = self.main_type(type_names)
+        if main_type is None or filename == "":
+            # Events about the watched directories themselves
+            return False
+        key = (stash_name, os.path.join(watch_path, filename))
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = {"since": time.monotonic(), "header": header,
+                     "watch_path": watch_path, "filename": filename,
+                     "existed": main_type not in self.appearing,
+                     "is_dir": "IN_ISDIR" in type_names}
+            self.pending[key] = entry
+        entry["last"] = main_type
+        if main_type in self.appearing:
+            entry["appeared"] = main_type
+        entry["is_dir"] = entry["is_dir"] or "IN_ISDIR" in type_names
+        return True
+
+    def net_type(self, entry):
+        exists = entry["last"] not in self.vanishing
+        if not entry["existed"]:
+            if not exists:
+                return None
+            return entry["appeared"]
+        if not exists:
+            return entry["last"]
+        return "IN_MODIFY"
+
+    def deadline(self):
+        if not self.pending:
+            return None
+        return min(e["since"] for e in self.pending.values()) + self.window
+
+    def pop_ready(self, force=False):
+        now = time.monotonic()
+        for key, entry in list(self.pending.items()):
+            if not force and now - entry["since"] < self.window:
+                continue
+            del self.pending[key]
+            net_type = self.net_type(entry)
+            if net_type is None:
+                continue
+            type_names = [net_type]
+            if entry["is_dir"]:
+                type_names.append("IN_ISDIR")
+            yield key[0], (entry["header"], type_names,
+                           entry["watch_path"], entry["filename"])
+
+    def forget(self, stash_name):
+        for key in [k for k in self.pending if k[0] == stash_name]:
+            del self.pending[key]
+
+
+def _close_scan(old_snapshot, future):
+    # The snapshot a rescan compares to is only closed once it is over
+    if old_snapshot is not None:
+        old_snapshot.close()
+    if not future.cancelled() and future.exception() is None:
+        future.result()[0].close()
+
+
+class Supervisor:
+    """
+    Single sync daemon, watching every mounted stash with one inotify
+    instance and scheduling their pushes from one place.
+
+    Stashes are registered and unregistered through a Unix socket. The
+    supervisor exits after idle_timeout seconds without any watched
+    stash.
+    """
+    watch_batch = 1000
+
+    def __init__(self, stash_manager, idle_timeout=30):
+        self.sm = stash_manager
+        self.sm.log_buffering = True
+        self.idle_timeout = idle_timeout
+        general_config = self.sm.config["general"]
+        self.watcher = Watcher(general_config.getint("max_watches", 0))
+        self.scan_interval = general_config.getfloat(
+            "unwatched_scan_interval", 60)
+        self.coalescer = EventCoalescer(
+            general_config.getfloat("coalesce_delay", 1))
+        self.last_scan = time.monotonic()
+        # Pushes run aside, not to miss events meanwhile. How many of
+        # them really run at once is up to the sync scheduler.
+        self.pushes = ThreadPoolExecutor(
+            max_workers=self.sm.scheduler.max_syncs)
+        # Walks of the stash trees, first ones and rescans
+        self.scans = ThreadPoolExecutor(max_workers=1)
+        self.stashes = {}
+        self.socket_path = supervisor_socket_path()
+        self.lock = FileLock(os.path.join(os.path.dirname(self.socket_path),
+                                          "supervisor.lock"))
+        self.server = None
+
+    def listen(self):
+        """
+        Start listening, unless another supervisor is already running.
+        Return whether this one is the running supervisor.
+        """
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700,
+                    exist_ok=True)
+        if not self.lock.acquire(blocking=False):
+            return False
+        # The socket belongs to the lock holder, it is only left over by
+        # a dead supervisor at this point.
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server.listen()
+        return True
+
+    def register(self, stash_name, mount_point):
+        if stash_name in self.stashes:
+            return
+        # New stashes may have been created since the supervisor start.
+        self.sm.config.read(self.sm.config_file)
+        self.sm.reload_stashes()
+        self.sm.valid_stash(stash_name)
+
+        stash = self.sm.stashes[stash_name]
+        watch_root = mount_point
+        if stash["watch_encrypted"]:
+            # Events are then directly expressed as ciphertext paths
+            watch_root = stash["encfs_root"]
+        size_tracker = SizeTracker(watch_root, stash["usage_file"])
+        # The tree is walked aside, not to keep the client and the other
+        # stashes waiting. Watches are only set up after that.
+        scan = (self.scans.submit(self.initial_scan, watch_root,
+                                  size_tracker, stash["snapshot_file"]),
+                None)
+        debouncer = Debouncer(stash["sync_quiet_delay"],
+                              stash["sync_max_delay"])
+        journal = SyncJournal(stash["journal_file"])
+        if journal.dirty():
+            # Replay changes left over by a previous session
+            debouncer.touch()
+        self.stashes[stash_name] = {
+            "mount_point": mount_point,
+            "watch_root": watch_root,
+            "encrypted": stash["watch_encrypted"],
+            "size_tracker": size_tracker,
+            "debouncer": debouncer,
+            "journal": journal,
+            "snapshot": None,
+            "snapshot_file": stash["snapshot_file"],
+            "scan": scan,
+            "queued_scan": set(),
+            "overflow": None,
+            "watch_setup": None,
+            "push": None
+        }
+        self.sm.log_activity(stash_name, "Starting inotify watch")
+
+    def initial_scan(self, watch_root, size_tracker, snapshot_file):
+        # Reference state to find changes happening while watches are
+        # being set up.
+        snapshot = self.map_snapshot(snapshot_file,
+                                     take_snapshot(watch_root))
+        return snapshot, size_tracker.seed_data(snapshot)
+
+    def collect_scans(self):
+        for stash_name, state in list(self.stashes.items()):
+            if state["scan"] is None or not state["scan"][0].done():
+                continue
+            (future, subtrees) = state["scan"]
+            state["scan"] = None
+            try:
+                result = future.result()
+            except Exception as e:
+                if state["snapshot"] is None:
+                    self.sm.log_activity(
+                        stash_name, "Initial scan failed: {}".format(e))
+                    self.unregister(stash_name)
+                    continue
+                self.sm.log_activity(stash_name,
+                                     "Rescan failed: {}".format(e))
+            else:
+                if state["snapshot"] is None:
+                    (state["snapshot"], seed) = result
+                    state["size_tracker"].apply_seed(seed)
+                    self.watcher.add_tree(stash_name, state["watch_root"])
+                    state["watch_setup"] = time.monotonic()
+                else:
+                    self.apply_rescan(stash_name, subtrees, *result)
+            if state["queued_scan"]:
+                subtrees = sorted(state["queued_scan"])
+                state["queued_scan"] = set()
+                self.submit_rescan(stash_name, subtrees)
+
+    def unregister(self, stash_name):
+        state = self.stashes.pop(stash_name, None)
+        if state is None:
+            return False
+        self.watcher.remove_stash(stash_name)
+        self.coalescer.forget(stash_name)
+        state["size_tracker"].discard()
+        state["journal"].close()
+        if state["scan"] is not None:
+            future = state["scan"][0]
+            future.cancel()
+            future.add_done_callback(
+                functools.partial(_close_scan, state["snapshot"]))
+        elif state["snapshot"] is not None:
+            state["snapshot"].close()
+        self.sm.log_activity(stash_name, "Stopping inotify watch")
+        return True
+
+    def handle_client(self):
+        conn, _addr = self.server.accept()
+        # A stuck client must not block the other stashes
+        conn.settimeout(CLIENT_TIMEOUT)
+        with conn:
+            try:
+                with conn.makefile("r") as f:
+                    line = f.readline()
+            except OSError:
+                return
+            try:
+                request = json.loads(line)
+                command = request.get("command")
+                answer = {"status": "ok"}
+                if command == "register":
+                    self.register(request["stash"], request["mount_point"])
+                elif command == "unregister":
+                    # Don't lose the last changes, which are still queued
+                    self.handle_events()
+                    self.handle_coalesced_events(True)
+                    answer["watched"] = self.unregister(request["stash"])
+                elif command != "list":
+                    raise ValueError("Unknown command {}".format(command))
+                answer["stashes"] = list(self.stashes)
+            except Exception as e:
+                answer = {"status": "error", "message": str(e)}
+            try:
+                conn.sendall((json.dumps(answer) + "\n").encode())
+            except OSError:
+                pass
+
+    def handle_events(self):
+        for stash_name, event in self.watcher.read_events():
+            if stash_name is None:
+                self.recover_overflow()
+                continue
+            if stash_name not in self.stashes:
+                continue
+            if not self.coalescer.add(stash_name, event):
+                self.handle_event(stash_name, event)
+
+    def handle_coalesced_events(self, force=False):
+        for stash_name, event in self.coalescer.pop_ready(force):
+            if stash_name in self.stashes:
+                self.handle_event(stash_name, event)
+
+    def handle_event(self, stash_name, event):
+        state = self.stashes[stash_name]
+        must_continue = self.sm.handle_inotify_event(
+            event, stash_name, state["size_tracker"])
+        if must_continue == 0:
+            self.unregister(stash_name)
+        elif must_continue == 1:
+            state["debouncer"].touch()
+            self.record_change(state, event)
+
+    def rescan(self, stash_name, subtrees=None):
+        """
+        Find changes of the given subtrees (absolute paths, or the whole
+        stash if None) by comparing them to the last known snapshot. The
+        tree is walked aside, and the changes are handled once it is
+        over by collect_scans.
+        """
+        state = self.stashes[stash_name]
+        if state["snapshot"] is None:
+            # Still walked for the first time
+            return
+        if subtrees is None:
+            subtrees = ["."]
+        else:
+            subtrees = [os.path.relpath(subtree, state["watch_root"])
+                        for subtree in subtrees]
+        if state["scan"] is not None:
+            # The snapshot is still being replaced, wait for the new one
+            state["queued_scan"].update(subtrees)
+            return
+        self.submit_rescan(stash_name, subtrees)
+
+    def submit_rescan(self, stash_name, subtrees):
+        state = self.stashes[stash_name]
+        state["scan"] = (self.scans.submit(
+            self.scan_changes, state["watch_root"], state["snapshot"],
+            subtrees, state["snapshot_file"]), subtrees)
+
+    def scan_changes(self, watch_root, old_snapshot, subtrees,
+                     snapshot_file):
+        # Untouched directories are copied from the last snapshot
+        snapshot = take_snapshot(watch_root, old_snapshot, subtrees)
+        (changed, removed_dirs) = diff_snapshots(old_snapshot, snapshot)
+        return self.map_snapshot(snapshot_file, snapshot), changed, \
+            removed_dirs
+
+    def apply_rescan(self, stash_name, subtrees, snapshot, changed,
+                     removed_dirs):
+        state = self.stashes[stash_name]
+        changed_paths = [p for p in changed
+                         if not self.sm.is_ignored(stash_name, p)]
+        state["snapshot"].close()
+        state["snapshot"] = snapshot
+
+        if removed_dirs:
+            state["size_tracker"].seed(snapshot)
+        else:
+            for path in changed_paths:
+                state["size_tracker"].update(
+                    os.path.join(state["watch_root"], path))
+
+        journal = state["journal"]
+        path_kind = "C" if state["encrypted"] else "P"
+        if removed_dirs or len(changed_paths) > MAX_TARGETED_CHANGES:
+            journal.require_full_sync()
+        else:
+            for path in changed_paths:
+                journal.record(path, path_kind)
+        if removed_dirs or changed_paths:
+            state["debouncer"].touch()
+
+        if state["overflow"] is not None and "." in subtrees:
+            state["size_tracker"].seed(snapshot)
+            self.sm.log_activity(
+                stash_name,
+                "Recovered from inotify queue overflow in {:.3f}s "
+                "({} changes found)".format(
+                    time.monotonic() - state["overflow"],
+                    len(changed_paths)))
+            state["overflow"] = None
+
+    def map_snapshot(self, snapshot_file, snapshot):
+        """
+        Store the given snapshot and return it memory-mapped, to keep it
+        out of the supervisor memory.
+        """
+        try:
+            snapshot.save(snapshot_file)
+        except OSError:
+            return snapshot
+        return TreeSnapshot.load(snapshot_file) or snapshot
+
+    def recover_overflow(self):
+        for stash_name, state in self.stashes.items():
+            if state["snapshot"] is None:
+                # No watch yet
+                continue
+            if state["overflow"] is None:
+                state["overflow"] = time.monotonic()
+            self.rescan(stash_name)
+            # Directories created during the overflow are not watched yet
+            self.watcher.add_tree(stash_name, state["watch_root"])
+
+    def process_pending_watches(self):
+        for stash_name in self.watcher.process_pending(self.watch_batch):
+            state = self.stashes.get(stash_name)
+            if state is None or state["watch_setup"] is None:
+                continue
+            setup_time = time.monotonic() - state["watch_setup"]
+            state["watch_setup"] = None
+            if setup_time > 1:
+                # Changes may have been missed before their directory
+                # was watched.
+                self.rescan(stash_name)
+            self.sm.log_activity(
+                stash_name, "Inotify watches set up in {:.3f}s".format(
+                    setup_time))
+
+    def scan_unwatched(self):
+        if time.monotonic() - self.last_scan < self.scan_interval:
+            return
+        for stash_name, subtrees in self.watcher.unwatched.items():
+            if stash_name in self.stashes:
+                self.rescan(stash_name, sorted(subtrees))
+        self.last_scan = time.monotonic()
+
+    def record_change(self, state, event):
+        (_header, type_names, watch_path, filename) = event
+        journal = state["journal"]
+        if journal.full_sync is not None:
+            return
+        if "IN_DELETE_SELF" in type_names or "IN_MOVE_SELF" in type_names \
+           or ("IN_ISDIR" in type_names and
+               ("IN_DELETE" in type_names or "IN_MOVED_FROM" in type_names)):
+            # Removing whole directories remotely requires a full push
+            journal.require_full_sync()
+            return
+        path_kind = "C" if state["encrypted"] else "P"
+        journal.record(os.path.relpath(os.path.join(watch_path, filename),
+                                       state["watch_root"]), path_kind)
+        if len(journal.pending) > MAX_TARGETED_CHANGES:
+            journal.require_full_sync()
+
+    def schedule_pushes(self):
+        self.collect_pushes()
+        mounted_stashes = self.sm.mounted_stashes()
+        for stash_name, state in list(self.stashes.items()):
+            if stash_name not in mounted_stashes:
+                # Unmounted behind our back
+                self.unregister(stash_name)
+                continue
+            state["size_tracker"].publish()
+            if state["push"] is not None or not state["debouncer"].due():
+                continue
+            journal = state["journal"]
+            path_kind = "C" if state["encrypted"] else "P"
+            state["debouncer"].reset()
+            state["push"] = (journal.seq, self.pushes.submit(
+                self.sm.inotify_push_stash, stash_name,
+                journal.changes(path_kind, MAX_TARGETED_CHANGES),
+                state["encrypted"]))
+
+    def collect_pushes(self):
+        for stash_name, state in self.stashes.items():
+            if state["push"] is None or not state["push"][1].done():
+                continue
+            (seq, future) = state["push"]
+            state["push"] = None
+            try:
+                must_sync = future.result()
+            except Exception as e:
+                self.sm.log_activity(stash_name,
+                                     "Sync failed: {}".format(e))
+                must_sync = True
+            if not must_sync:
+                state["journal"].acknowledge(seq)
+                state["debouncer"].succeeded()
+            else:
+                # Try again later, not to hammer an unreachable remote
+                state["debouncer"].failed()
+
+    def poll_timeout(self):
+        deadlines = [state["debouncer"].deadline()
+                     for state in self.stashes.values()
+                     if state["debouncer"].pending()]
+        if self.coalescer.pending:
+            deadlines.append(self.coalescer.deadline())
+        if self.watcher.pending:
+            # Keep setting up watches between events
+            return 0
+        if any(state["scan"] is not None for state in self.stashes.values()):
+            return 0.1
+        if not deadlines:
+            return 1
+        return min(1, max(0, min(deadlines) - time.monotonic()))
+
+    def serve(self):
+        if not self.listen():
+            # Clients will reach the running one
+            self.pushes.shutdown()
+            self.scans.shutdown()
+            self.watcher.close()
+            return
+        poller = select.epoll()
+        poller.register(self.server.fileno(), select.EPOLLIN)
+        poller.register(self.watcher.fileno(), select.EPOLLIN)
+        idle_since = time.monotonic()
+        try:
+            while True:
+                for fd, _mask in poller.poll(self.poll_timeout()):
+                    if fd == self.server.fileno():
+                        self.handle_client()
+                    else:
+                        self.handle_events()
+                self.handle_coalesced_events()
+                self.collect_scans()
+                self.process_pending_watches()
+                self.scan_unwatched()
+                self.schedule_pushes()
+                self.sm.flush_activity_logs()
+                if self.stashes:
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since > self.idle_timeout:
+                    break
+        finally:
+            for stash_name in list(self.stashes):
+                self.unregister(stash_name)
+            self.pushes.shutdown()
+            self.scans.shutdown()
+            self.sm.flush_activity_logs(True)
+            poller.close()
+            self.server.close()
+            os.remove(self.socket_path)
+            self.lock.release()
+            self.watcher.close()
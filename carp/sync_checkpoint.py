@@ -0,0 +1,58 @@
+import os
+import json
+import time
+
+
+class SyncCheckpoint:
+    """
+    Record of the pulls and pushes of a stash which did not complete.
+
+    A sync is recorded when it starts and forgotten once it succeeds.
+    A sync finding its own direction still recorded thus resumes an
+    interrupted one, whose partial transfers were kept by rsync.
+    """
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+
+    def load(self):
+        try:
+            with open(self.checkpoint_file, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+    def save(self, state):
+        if not state:
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+            return
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def begin(self, direction, remote_path):
+        """
+        Record the start of a sync. Return the record of the interrupted
+        sync it resumes, or None.
+        """
+        state = self.load()
+        previous = state.get(direction)
+        if previous is not None and \
+           previous.get("remote_path") != remote_path:
+            # Partial transfers towards another remote are useless
+            previous = None
+        state[direction] = {
+            "remote_path": remote_path,
+            "started": int(time.time()),
+            "attempts": previous["attempts"] + 1 if previous else 1}
+        self.save(state)
+        return previous
+
+    def end(self, direction):
+        state = self.load()
+        if state.pop(direction, None) is not None:
+            self.save(state)
@@ -0,0 +1,114 @@
+import os
+import json
+
+
+class SyncJournal:
+    """
+    Append-only journal of the paths of a stash waiting to be pushed.
+
+    Each line is a JSON array. Dirty paths are recorded as
+    [seq, kind, path], where kind is "P" for a plaintext path relative
+    to the mount point, "C" for a ciphertext path relative to the
+    encrypted root, or "F" when a full push is required. A successful
+    push is recorded as [seq, "A"], which acknowledges every entry up to
+    seq. The file is rewritten with only the outstanding entries once
+    enough of them have been acknowledged.
+    """
+    compact_threshold = 1000
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.seq = 0
+        self.pending = {}
+        self.full_sync = None
+        self.dead_lines = 0
+        self.load()
+        self.journal = open(self.journal_file, "a")
+
+    def load(self):
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be truncated after a crash
+                    continue
+                self._apply(entry)
+
+    def _apply(self, entry):
+        seq = entry[0]
+        self.seq = max(self.seq, seq)
+        kind = entry[1]
+        if kind == "A":
+            self.dead_lines += 1 + sum(
+                1 for (s, _k) in self.pending.values() if s <= seq)
+            self.pending = {p: v for p, v in self.pending.items()
+                            if v[0] > seq}
+            if self.full_sync is not None and self.full_sync <= seq:
+                self.full_sync = None
+                self.dead_lines += 1
+        elif kind == "F":
+            self.full_sync = seq
+        else:
+            if entry[2] in self.pending:
+                self.dead_lines += 1
+            self.pending[entry[2]] = (seq, kind)
+
+    def _write(self, entry):
+        self._apply(entry)
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
+
+    def record(self, path, kind="P"):
+        self.seq += 1
+        self._write([self.seq, kind, path])
+
+    def require_full_sync(self):
+        self.seq += 1
+        self._write([self.seq, "F"])
+
+    def dirty(self):
+        return self.full_sync is not None or bool(self.pending)
+
+    def changes(self, kind, max_changes=None):
+        """
+        Return the outstanding paths of the given kind, or None if a
+        full push is required instead.
+        """
+        if self.full_sync is not None:
+            return None
+        if any(k != kind for (_s, k) in self.pending.values()):
+            # Recorded by a previous session with another watch mode
+            return None
+        if max_changes is not None and len(self.pending) > max_changes:
+            return None
+        return sorted(self.pending)
+
+    def acknowledge(self, seq):
+        self._write([seq, "A"])
+        os.fsync(self.journal.fileno())
+        if self.dead_lines > self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        tmp_file = self.journal_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            if self.full_sync is not None:
+                f.write(json.dumps([self.full_sync, "F"]) + "\n")
+            for path, (seq, kind) in sorted(self.pending.items(),
+                                            key=lambda x: x[1][0]):
+                f.write(json.dumps([seq, kind, path]) + "\n")
+            if not self.dirty():
+                # Keep the sequence going after a compaction
+                f.write(json.dumps([self.seq, "A"]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal.close()
+        os.replace(tmp_file, self.journal_file)
+        self.journal = open(self.journal_file, "a")
+        self.dead_lines = 0
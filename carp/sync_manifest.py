@@ -0,0 +1,152 @@
+import os
+import gzip
+import json
+import stat
+import hashlib
+from carp.transfer_profile import BIG_FILE_SIZE
+
+# Names of the manifest files kept at the root of a remote stash. The
+# marker only holds the tree digest, to be checked cheaply, the detail
+# holds the whole manifest.
+MARKER_NAME = ".carp-manifest"
+DETAIL_NAME = ".carp-manifest.json.gz"
+# Marker content while the remote stash is being changed
+DIRTY_MARKER = "dirty"
+
+# Above this number of changed directories, filtering them is not worth
+# it anymore.
+MAX_NARROWED_DIRS = 1000
+
+
+def _digest(parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8", "surrogateescape"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def build_manifest(root):
+    """
+    Return the manifest of the given tree, as a dict with the digest of
+    the whole tree and a {relative dir: [mtime, count, size, own digest,
+    tree digest, big size]} summary of each directory, where big size
+    is the size of its files above BIG_FILE_SIZE.
+
+    The own digest of a directory covers the name, size and mtime of
+    its files and the names of its subdirectories. Its tree digest also
+    covers the tree digests of its subdirectories. Mtimes are truncated
+    to the second, as not every remote keeps them more precisely.
+    """
+    dirs = {}
+
+    def walk(rel_dir):
+        own = []
+        subdirs = []
+        size = 0
+        big_size = 0
+        count = 0
+        try:
+            st = os.stat(os.path.join(root, rel_dir), follow_symlinks=False)
+            with os.scandir(os.path.join(root, rel_dir)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        for entry in entries:
+            if rel_dir == "" and entry.name.startswith(MARKER_NAME):
+                continue
+            try:
+                entry_st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISDIR(entry_st.st_mode):
+                own += ["d", entry.name]
+                subdirs.append(entry.name)
+                continue
+            own += ["f", entry.name, str(entry_st.st_size),
+                    str(entry_st.st_mtime_ns // 1000000000)]
+            size += entry_st.st_size
+            if entry_st.st_size >= BIG_FILE_SIZE:
+                big_size += entry_st.st_size
+            count += 1
+        own_digest = _digest(own)
+        tree = [own_digest]
+        for name in subdirs:
+            sub_digest = walk(os.path.join(rel_dir, name))
+            if sub_digest is not None:
+                tree += [name, sub_digest]
+        tree_digest = _digest(tree)
+        dirs[rel_dir or "."] = [st.st_mtime_ns // 1000000000, count, size,
+                                own_digest, tree_digest, big_size]
+        return tree_digest
+
+    return {"digest": walk(""), "dirs": dirs}
+
+
+def load_manifest(manifest_file):
+    try:
+        with gzip.open(manifest_file, "rt") as f:
+            manifest = json.load(f)
+    except (OSError, EOFError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or "digest" not in manifest:
+        return None
+    return manifest
+
+
+def save_manifest(manifest, manifest_file):
+    tmp_file = manifest_file + ".tmp"
+    with gzip.open(tmp_file, "wt") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def diff_manifests(source, destination):
+    """
+    Return the sorted list of the directories to sync for destination
+    to match source, or None if the whole tree must be synced.
+    """
+    if source is None or destination is None:
+        return None
+    if source["digest"] == destination["digest"]:
+        return []
+    src_dirs = source["dirs"]
+    dest_dirs = destination["dirs"]
+    if any(d not in src_dirs for d in dest_dirs):
+        # Removing whole directories requires a full sync
+        return None
+    changed = sorted(d for d, summary in src_dirs.items()
+                     if d not in dest_dirs
+                     or dest_dirs[d][3] != summary[3])
+    if len(changed) > MAX_NARROWED_DIRS:
+        return None
+    return changed
+
+
+def _escape_pattern(path):
+    for char in "\\*?[":
+        path = path.replace(char, "\\" + char)
+    return path
+
+
+def write_filter(changed_dirs, filter_file):
+    """
+    Write rsync filter rules restricting a sync to the direct content of
+    the given directories, excluding everything else.
+    """
+    rules = ["- /" + _escape_pattern(MARKER_NAME) + "*"]
+    included = set()
+    for rel_dir in changed_dirs:
+        if rel_dir == ".":
+            rules.append("+ /*")
+            continue
+        parts = rel_dir.split(os.sep)
+        for i in range(1, len(parts) + 1):
+            parent = "/" + "/".join(parts[:i]) + "/"
+            if parent not in included:
+                included.add(parent)
+                rules.append("+ " + _escape_pattern(parent))
+        rules.append("+ /" + _escape_pattern(rel_dir) + "/*")
+    rules.append("- *")
+    with open(filter_file, "w") as f:
+        f.write("\n".join(rules) + "\n")
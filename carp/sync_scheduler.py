@@ -0,0 +1,156 @@
+import os
+import time
+import fcntl
+import threading
+from carp.ssh_pool import remote_destination
+from xdg.BaseDirectory import get_runtime_dir
+
+# Lower values run first
+PRIORITY_UMOUNT = 0
+PRIORITY_USER = 10
+PRIORITY_DAEMON = 20
+
+
+def sync_runtime_dir():
+    return os.path.join(get_runtime_dir(strict=False), "carp", "sync")
+
+
+def remote_host(remote_path):
+    """Return the host part of a rsync remote path, or "" if local."""
+    destination = remote_destination(remote_path)
+    if destination is None:
+        return ""
+    return destination.rsplit("@", 1)[-1]
+
+
+class FileLock:
+    """Exclusive flock held on a file, released with the file."""
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+
+
+class SyncSlot(FileLock):
+    def write(self, host):
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, host.encode(), 0)
+
+    def release(self):
+        if self.fd is not None:
+            os.ftruncate(self.fd, 0)
+        super().release()
+
+
+class SyncScheduler:
+    """
+    Per user limit of the syncs running at once, shared by every carp
+    process (CLI, tray icon and sync supervisor).
+
+    Each running sync holds one of the max_syncs slot files locked.
+    Waiting syncs hold a waiter file named after their priority, thus
+    a free slot is only taken by one of the waiters with the highest
+    priority. Slot files also record the remote host of their sync, to
+    share a bandwidth cap between the syncs towards a same host.
+    """
+    poll_delay = 0.2
+
+    def __init__(self, max_syncs=2, runtime_dir=None):
+        self.max_syncs = max(1, max_syncs)
+        self.runtime_dir = runtime_dir or sync_runtime_dir()
+        os.makedirs(self.runtime_dir, mode=0o700, exist_ok=True)
+
+    def slot_file(self, number):
+        return os.path.join(self.runtime_dir, "slot.{}".format(number))
+
+    def waiter_file(self, priority):
+        return os.path.join(self.runtime_dir, "wait.{}.{}.{}".format(
+            priority, os.getpid(), threading.get_ident()))
+
+    def higher_priority_waiting(self, priority):
+        for name in os.listdir(self.runtime_dir):
+            if not name.startswith("wait."):
+                continue
+            try:
+                other_priority = int(name.split(".")[1])
+            except (IndexError, ValueError):
+                continue
+            if other_priority >= priority:
+                continue
+            other = FileLock(os.path.join(self.runtime_dir, name))
+            if not other.acquire(blocking=False):
+                # Alive and waiting
+                return True
+            # Left by a dead process
+            try:
+                os.remove(other.lock_file)
+            except FileNotFoundError:
+                pass
+            other.release()
+        return False
+
+    def try_acquire_slot(self, host):
+        for number in range(self.max_syncs):
+            slot = SyncSlot(self.slot_file(number))
+            if slot.acquire(blocking=False):
+                slot.write(host)
+                return slot
+        return None
+
+    def acquire(self, priority=PRIORITY_USER, host="", blocking=True):
+        """
+        Return a held SyncSlot, or None if blocking is False and no slot
+        is available right now.
+        """
+        waiter = FileLock(self.waiter_file(priority))
+        waiter.acquire()
+        try:
+            while True:
+                if not self.higher_priority_waiting(priority):
+                    slot = self.try_acquire_slot(host)
+                    if slot is not None:
+                        return slot
+                if not blocking:
+                    return None
+                time.sleep(self.poll_delay)
+        finally:
+            os.remove(waiter.lock_file)
+            waiter.release()
+
+    def running_towards(self, host, own_slot=None):
+        """Return the number of running syncs towards the given host."""
+        count = 0
+        for number in range(self.max_syncs):
+            slot = SyncSlot(self.slot_file(number))
+            if own_slot is not None and slot.lock_file == own_slot.lock_file:
+                count += 1
+                continue
+            if slot.acquire(blocking=False):
+                # Free slot, maybe left over by a dead process
+                slot.release()
+                continue
+            try:
+                with open(slot.lock_file, "r") as f:
+                    if f.read() == host:
+                        count += 1
+            except FileNotFoundError:
+                continue
+        return count
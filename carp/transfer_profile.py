@@ -0,0 +1,85 @@
+import os
+from carp.ssh_pool import is_local_path
+
+# Settings of each transfer profile. Missing settings keep the rsync
+# default behaviour.
+PROFILES = {
+    # Plain rsync -av, as before profiles existed
+    "standard": {},
+    # Ciphertext does not compress, and big files are better updated in
+    # place than rewritten entirely.
+    "big_files": {"large_files": "inplace", "compress": False,
+                  "block_size": 131072},
+    # Sending whole files is faster than computing deltas on fast links
+    "lan": {"whole_file": True, "compress": False},
+    "local": {"whole_file": True},
+    # Files are compared by content instead of size and mtime
+    "checksum": {"checksum": True},
+}
+
+LARGE_FILES_MODES = ["none", "inplace", "partial"]
+
+# Partial transfers are kept in this directory, relatively to the one
+# of the file being transferred, unless another one is given.
+PARTIAL_DIR = ".carp-partial"
+
+# Files above this size are considered big
+BIG_FILE_SIZE = 64 * 1024 * 1024
+
+
+def auto_profile(remote_path, manifest=None):
+    """
+    Return the name of the profile best suited to the given remote and
+    to the file sizes described by the given sync manifest.
+    """
+    if is_local_path(remote_path):
+        return "local"
+    if manifest is None:
+        return "standard"
+    total_size = 0
+    big_size = 0
+    for summary in manifest["dirs"].values():
+        total_size += summary[2]
+        big_size += summary[5]
+    if total_size > 0 and big_size * 2 >= total_size:
+        # Most of the stash is made of big files
+        return "big_files"
+    return "standard"
+
+
+def rsync_options(settings, partial_dir=PARTIAL_DIR):
+    """Return the rsync options matching the given profile settings."""
+    options = []
+    large_files = settings.get("large_files", "none")
+    if large_files == "inplace":
+        options.append("--inplace")
+    elif large_files == "partial":
+        # Left over partial transfers are never part of the stash
+        options += ["--partial-dir={}".format(partial_dir),
+                    "--exclude={}/".format(PARTIAL_DIR)]
+    if "compress" in settings:
+        options.append("--compress" if settings["compress"]
+                       else "--no-compress")
+    if "whole_file" in settings:
+        options.append("--whole-file" if settings["whole_file"]
+                       else "--no-whole-file")
+    if settings.get("checksum", False):
+        options.append("--checksum")
+    if settings.get("block_size", 0) > 0:
+        options.append("--block-size={}".format(settings["block_size"]))
+    return options
+
+
+def shard_partial_dir(arg, shard):
+    """
+    Return the given rsync argument, with its partial directory moved
+    to a subdirectory of the given shard if absolute. Concurrent rsyncs
+    would otherwise mix up the partial files of same named files.
+    """
+    if not arg.startswith("--partial-dir="):
+        return arg
+    partial_dir = arg.split("=", 1)[1]
+    if not os.path.isabs(partial_dir):
+        # Relative to each file directory, thus already apart
+        return arg
+    return "--partial-dir={}".format(os.path.join(partial_dir, shard))
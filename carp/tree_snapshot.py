@@ -0,0 +1,357 @@
+import os
+import mmap
+import stat
+import struct
+from array import array
+from collections import deque
+
+# File layout: the header, then the columns, each holding one 8 bytes
+# item per entry (name offsets hold one more, the end of the last name),
+# then the string table of the NUL terminated entry names.
+MAGIC = b"CARPTRE1"
+HEADER = struct.Struct("<8sQQ")
+COLUMNS = [("inodes", "Q"), ("sizes", "q"), ("mtimes", "q"), ("modes", "q"),
+           ("children", "q"), ("counts", "q"), ("name_offsets", "q")]
+
+
+class TreeSnapshot:
+    """
+    Compact description of a file tree.
+
+    Entries are stored in columns (inode, size, mtime_ns, mode, first
+    child, number of children and name offset in the string table),
+    in breadth-first order, the root being entry 0. The children of a
+    directory are contiguous and sorted by name, and files have -1
+    children. A loaded snapshot is memory-mapped, not read.
+    """
+    def __init__(self, columns, names, backing=None):
+        for name, _typecode in COLUMNS:
+            setattr(self, name, columns[name])
+        self.names = names
+        self.backing = backing
+
+    def __len__(self):
+        return len(self.inodes)
+
+    def name(self, index):
+        return bytes(self.names[self.name_offsets[index]:
+                                self.name_offsets[index + 1] - 1])
+
+    def is_dir(self, index):
+        return self.counts[index] >= 0
+
+    def child_names(self, index):
+        start = self.children[index]
+        return [self.name(i) for i in range(start, start + self.counts[index])]
+
+    def find_child(self, index, name):
+        """Return the index of the given child (bytes), or None."""
+        if not self.is_dir(index):
+            return None
+        # Bisect over the entries themselves, children being sorted
+        low = self.children[index]
+        end = high = low + self.counts[index]
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < end and self.name(low) == name:
+            return low
+        return None
+
+    def walk_files(self):
+        """Yield the (relative path, size) of every entry but directories."""
+        if len(self) == 0:
+            return
+        stack = [(0, b"")]
+        while stack:
+            (index, rel_dir) = stack.pop()
+            start = self.children[index]
+            for child in range(start, start + self.counts[index]):
+                path = os.path.join(rel_dir, self.name(child))
+                if self.is_dir(child):
+                    stack.append((child, path))
+                else:
+                    yield path, self.sizes[child]
+
+    def block(self, column, start, count):
+        """Return the raw bytes of count items of a column."""
+        data = memoryview(getattr(self, column)).cast("B")
+        return data[start * 8:(start + count) * 8].tobytes()
+
+    def names_block(self, start, count):
+        return bytes(self.names[self.name_offsets[start]:
+                                self.name_offsets[start + count]])
+
+    def save(self, snapshot_file):
+        tmp_file = snapshot_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(self), len(self.names)))
+            for name, _typecode in COLUMNS:
+                f.write(memoryview(getattr(self, name)).cast("B"))
+            f.write(self.names)
+        os.replace(tmp_file, snapshot_file)
+
+    @classmethod
+    def load(cls, snapshot_file):
+        """Map the given snapshot file, or return None if unusable."""
+        try:
+            with open(snapshot_file, "rb") as f:
+                backing = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(backing) < HEADER.size:
+            backing.close()
+            return None
+        (magic, count, names_size) = HEADER.unpack_from(backing)
+        expected = HEADER.size + (len(COLUMNS) * count + 1) * 8 + names_size
+        if magic != MAGIC or len(backing) != expected:
+            backing.close()
+            return None
+        data = memoryview(backing)
+        offset = HEADER.size
+        columns = {}
+        for name, typecode in COLUMNS:
+            items = count + 1 if name == "name_offsets" else count
+            columns[name] = data[offset:offset + items * 8].cast(typecode)
+            offset += items * 8
+        return cls(columns, data[offset:], backing)
+
+    def close(self):
+        if self.backing is None:
+            return
+        for name, _typecode in COLUMNS:
+            getattr(self, name).release()
+        self.names.release()
+        self.backing.close()
+        self.backing = None
+
+
+class _Builder:
+    def __init__(self):
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+        self.columns["name_offsets"].append(0)
+        self.names = bytearray()
+
+    def add(self, name, st):
+        columns = self.columns
+        columns["inodes"].append(st.st_ino)
+        columns["sizes"].append(st.st_size)
+        columns["mtimes"].append(st.st_mtime_ns)
+        columns["modes"].append(st.st_mode)
+        columns["children"].append(-1)
+        columns["counts"].append(0 if stat.S_ISDIR(st.st_mode) else -1)
+        self.names += name + b"\0"
+        columns["name_offsets"].append(len(self.names))
+
+    def copy(self, snapshot, start, count):
+        """Copy count contiguous entries of another snapshot."""
+        columns = self.columns
+        # The children of directories are set once they are processed
+        for name in ["inodes", "sizes", "mtimes", "modes", "children",
+                     "counts"]:
+            columns[name].frombytes(snapshot.block(name, start, count))
+        shift = len(self.names) - snapshot.name_offsets[start]
+        columns["name_offsets"].extend(
+            o + shift for o in
+            snapshot.name_offsets[start + 1:start + count + 1])
+        self.names += snapshot.names_block(start, count)
+
+    def snapshot(self):
+        return TreeSnapshot(self.columns, bytes(self.names))
+
+
+def _scan(path):
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    entries.append((entry.name,
+                                    entry.stat(follow_symlinks=False)))
+                except FileNotFoundError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+
+def take_snapshot(root, previous=None, subtrees=None):
+    """
+    Return a TreeSnapshot of the given tree.
+
+    When a previous snapshot and a list of relative subtrees are given,
+    only these subtrees and their parents are read again, the other
+    directories are copied from the previous snapshot.
+    """
+    builder = _Builder()
+    root = os.fsencode(root)
+    try:
+        root_st = os.stat(root)
+    except FileNotFoundError:
+        return builder.snapshot()
+    if not stat.S_ISDIR(root_st.st_mode):
+        return builder.snapshot()
+    builder.add(b"", root_st)
+
+    if previous is None or len(previous) == 0:
+        subtrees = None
+    if subtrees is not None:
+        subtrees = [os.fsencode(os.path.normpath(s)) for s in subtrees]
+        if b"." in subtrees:
+            subtrees = None
+
+    def must_scan(rel_path):
+        return subtrees is None or any(
+            rel_path == s or rel_path.startswith(s + b"/") or
+            s.startswith(rel_path + b"/") for s in subtrees)
+
+    columns = builder.columns
+    # (index, relative path, previous index), in breadth-first order
+    queue = deque([(0, b"", 0 if subtrees is not None else None)])
+    while queue:
+        (index, rel_path, prev_index) = queue.popleft()
+        start = len(columns["inodes"])
+        if rel_path == b"" or must_scan(rel_path):
+            for name, st in _scan(os.path.join(root, rel_path)):
+                builder.add(name, st)
+            scanned = True
+        else:
+            prev_start = previous.children[prev_index]
+            builder.copy(previous, prev_start, previous.counts[prev_index])
+            scanned = False
+        columns["children"][index] = start
+        columns["counts"][index] = len(columns["inodes"]) - start
+
+        for child in range(start, len(columns["inodes"])):
+            if columns["counts"][child] < 0:
+                continue
+            name = builder.names[columns["name_offsets"][child]:
+                                 columns["name_offsets"][child + 1] - 1]
+            child_path = os.path.join(rel_path, bytes(name))
+            prev_child = None
+            if not scanned:
+                prev_child = prev_start + child - start
+            elif subtrees is not None:
+                if prev_index is not None:
+                    prev_child = previous.find_child(prev_index, bytes(name))
+                if prev_child is None or not previous.is_dir(prev_child):
+                    prev_child = None
+                    if not must_scan(child_path):
+                        # Unknown before, it must be read after all
+                        subtrees.append(child_path)
+            queue.append((child, child_path, prev_child))
+    return builder.snapshot()
+
+
+def _subtree(snapshot, index, rel_path):
+    """Return the (path, is_dir) of an entry and of its descendants."""
+    entries = []
+    stack = [(index, rel_path)]
+    while stack:
+        (index, rel_path) = stack.pop()
+        is_dir = snapshot.is_dir(index)
+        entries.append((rel_path, is_dir))
+        if is_dir:
+            start = snapshot.children[index]
+            for child in range(start, start + snapshot.counts[index]):
+                stack.append((child, os.path.join(
+                    rel_path, snapshot.name(child))))
+    return entries
+
+
+def diff_snapshots(old, new):
+    """
+    Return the sorted list of paths which differ between the two given
+    snapshots, and whether some directories have been removed.
+
+    Entries are compared by kind, size and mtime. Directories whose list
+    of entries did not change are compared column by column, and only
+    their subdirectories are then looked into.
+    """
+    changed = []
+    removed_dirs = False
+
+    def added(snapshot, index, path):
+        changed.extend(p for p, _is_dir in _subtree(snapshot, index, path))
+
+    def removed(snapshot, index, path):
+        nonlocal removed_dirs
+        for p, is_dir in _subtree(snapshot, index, path):
+            if is_dir:
+                removed_dirs = True
+            else:
+                changed.append(p)
+
+    def compare(old_child, new_child, path, stack):
+        old_dir = old.is_dir(old_child)
+        new_dir = new.is_dir(new_child)
+        if old_dir and new_dir:
+            # Only the content of this directory may have changed, which
+            # is reported by its children.
+            stack.append((old_child, new_child, path))
+            return
+        if old_dir:
+            old_start = old.children[old_child]
+            for child in range(old_start, old_start + old.counts[old_child]):
+                removed(old, child, os.path.join(path, old.name(child)))
+            changed.append(path)
+        elif new_dir:
+            added(new, new_child, path)
+        elif stat.S_IFMT(old.modes[old_child]) != \
+                stat.S_IFMT(new.modes[new_child]) or \
+                old.sizes[old_child] != new.sizes[new_child] or \
+                old.mtimes[old_child] != new.mtimes[new_child]:
+            changed.append(path)
+
+    if len(old) == 0 or len(new) == 0:
+        if len(old) > 0:
+            removed(old, 0, b"")
+        if len(new) > 0:
+            added(new, 0, b"")
+        # The root itself is not part of the tree
+        return sorted(os.fsdecode(p) for p in changed if p != b""), \
+            removed_dirs
+
+    stack = [(0, 0, b"")]
+    while stack:
+        (old_dir, new_dir, rel_path) = stack.pop()
+        old_start = old.children[old_dir]
+        old_count = old.counts[old_dir]
+        new_start = new.children[new_dir]
+        new_count = new.counts[new_dir]
+        if old_count == new_count and \
+           old.names_block(old_start, old_count) == \
+           new.names_block(new_start, new_count):
+            # Same entries, at the same positions
+            if all(old.block(column, old_start, old_count) ==
+                   new.block(column, new_start, new_count)
+                   for column in ["sizes", "mtimes", "modes"]):
+                for offset in range(old_count):
+                    if new.is_dir(new_start + offset):
+                        stack.append((old_start + offset,
+                                      new_start + offset,
+                                      os.path.join(rel_path, new.name(
+                                          new_start + offset))))
+                continue
+            for offset in range(old_count):
+                compare(old_start + offset, new_start + offset,
+                        os.path.join(rel_path, new.name(new_start + offset)),
+                        stack)
+            continue
+
+        old_names = dict(zip(old.child_names(old_dir),
+                             range(old_start, old_start + old_count)))
+        for offset, name in enumerate(new.child_names(new_dir)):
+            path = os.path.join(rel_path, name)
+            old_child = old_names.pop(name, None)
+            if old_child is None:
+                added(new, new_start + offset, path)
+            else:
+                compare(old_child, new_start + offset, path, stack)
+        for name, old_child in old_names.items():
+            removed(old, old_child, os.path.join(rel_path, name))
+    return sorted(os.fsdecode(p) for p in changed), removed_dirs
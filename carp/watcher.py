@@ -0,0 +1,185 @@
+import os
+import struct
+import inotify.calls
+import inotify.constants
+from collections import Counter, deque, namedtuple
+
+
+InotifyHeader = namedtuple("InotifyHeader", ["wd", "mask", "cookie", "len"])
+
+HEADER_FORMAT = "iIII"
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+
+# We only care about events which may require a sync.
+WATCH_MASK = inotify.constants.IN_CREATE | inotify.constants.IN_DELETE | \
+    inotify.constants.IN_DELETE_SELF | inotify.constants.IN_MODIFY | \
+    inotify.constants.IN_CLOSE_WRITE | inotify.constants.IN_MOVED_FROM | \
+    inotify.constants.IN_MOVED_TO | inotify.constants.IN_MOVE_SELF | \
+    inotify.constants.IN_ONLYDIR
+
+
+def event_names(mask):
+    return [name for bit, name in inotify.constants.MASK_LOOKUP.items()
+            if mask & bit]
+
+
+def default_max_watches():
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches", "r") as f:
+            # Leave some room to the other inotify users
+            return int(f.read()) // 2
+    except (OSError, ValueError):
+        return 4096
+
+
+class Watcher:
+    """
+    One inotify instance shared by every watched stash.
+
+    Directories are watched breadth first, a batch at a time, through
+    process_pending. The watch table only keeps the parent watch
+    descriptor and the name of each watched directory. Once max_watches
+    is reached, the remaining subtrees are listed in unwatched, for the
+    caller to scan them by other means.
+
+    Events are yielded as (stash_name, event) tuples, where event has the
+    same (header, type_names, watch_path, filename) shape as the ones of
+    the inotify.adapters module. A queue overflow is yielded with a None
+    stash_name.
+    """
+    def __init__(self, max_watches=None):
+        self.fd = inotify.calls.inotify_init()
+        os.set_blocking(self.fd, False)
+        self.max_watches = max_watches or default_max_watches()
+        self.watches = {}
+        self.pending = deque()
+        self.queued = Counter()
+        self.unwatched = {}
+        self.buffer = b""
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch_path(self, wd):
+        names = []
+        while wd is not None:
+            watch = self.watches.get(wd)
+            if watch is None:
+                # One of the parents is not watched anymore
+                return None
+            (_stash_name, wd, name) = watch
+            names.append(name)
+        return os.path.join(*reversed(names))
+
+    def add_watch(self, stash_name, parent_wd, name):
+        """
+        Watch one directory and queue its subdirectories. Return False
+        if the watch budget is exhausted.
+        """
+        path = name
+        if parent_wd is not None:
+            parent_path = self.watch_path(parent_wd)
+            if parent_path is None:
+                return True
+            path = os.path.join(parent_path, name)
+        if len(self.watches) >= self.max_watches:
+            self.unwatched.setdefault(stash_name, set()).add(path)
+            return False
+        try:
+            wd = inotify.calls.inotify_add_watch(
+                self.fd, os.fsencode(path), WATCH_MASK)
+        except inotify.calls.InotifyError:
+            # Directory vanished in the meantime
+            return True
+        # A moved directory keeps its watch descriptor, which is then
+        # simply relocated.
+        self.watches[wd] = (stash_name, parent_wd, name)
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.pending.append((stash_name, wd, entry.name))
+                        self.queued[stash_name] += 1
+        except OSError:
+            pass
+        return True
+
+    def add_tree(self, stash_name, root):
+        self.pending.append((stash_name, None, root))
+        self.queued[stash_name] += 1
+
+    def process_pending(self, limit=1000):
+        """
+        Add at most limit watches from the queue. Return the set of
+        stashes which have no more directory waiting to be watched.
+        """
+        done = set()
+        while self.pending and limit > 0:
+            (stash_name, parent_wd, name) = self.pending.popleft()
+            self.queued[stash_name] -= 1
+            if parent_wd is None or parent_wd in self.watches:
+                # Else, parent has been removed meanwhile
+                self.add_watch(stash_name, parent_wd, name)
+                limit -= 1
+            if self.queued[stash_name] == 0:
+                del self.queued[stash_name]
+                done.add(stash_name)
+        return done
+
+    def remove_stash(self, stash_name):
+        self.pending = deque(p for p in self.pending if p[0] != stash_name)
+        self.queued.pop(stash_name, None)
+        self.unwatched.pop(stash_name, None)
+        for wd, (watched_stash, _parent, _name) in list(self.watches.items()):
+            if watched_stash != stash_name:
+                continue
+            del self.watches[wd]
+            try:
+                inotify.calls.inotify_rm_watch(self.fd, wd)
+            except inotify.calls.InotifyError:
+                pass
+
+    def read_events(self):
+        try:
+            self.buffer += os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+
+        pos = 0
+        while len(self.buffer) - pos >= HEADER_LENGTH:
+            header = InotifyHeader(
+                *struct.unpack_from(HEADER_FORMAT, self.buffer, pos))
+            event_end = pos + HEADER_LENGTH + header.len
+            if len(self.buffer) < event_end:
+                break
+            filename = os.fsdecode(
+                self.buffer[pos + HEADER_LENGTH:event_end].rstrip(b"\0"))
+            pos = event_end
+
+            if header.mask & inotify.constants.IN_Q_OVERFLOW:
+                # Events have been lost, for every watched stash
+                yield None, (header, event_names(header.mask), None, "")
+                continue
+            watch = self.watches.get(header.wd)
+            if watch is None:
+                continue
+            stash_name = watch[0]
+            watch_path = self.watch_path(header.wd)
+            if header.mask & inotify.constants.IN_IGNORED:
+                # Watched directory has been removed
+                del self.watches[header.wd]
+                continue
+            if watch_path is None:
+                continue
+            if header.mask & inotify.constants.IN_ISDIR and \
+               header.mask & (inotify.constants.IN_CREATE |
+                              inotify.constants.IN_MOVED_TO):
+                # Watch new directories right now, to not miss their
+                # first entries.
+                self.add_watch(stash_name, header.wd, filename)
+            yield stash_name, (header, event_names(header.mask),
+                               watch_path, filename)
+        self.buffer = self.buffer[pos:]
@@ -0,0 +1,83 @@
+import os
+import errno
+import tempfile
+import unittest
+from carp.local_sync import LocalSync
+
+
+class FailingSync(LocalSync):
+    def copy_file(self, rel_path, src_st):
+        if os.path.basename(rel_path) == "broken":
+            raise OSError(errno.EIO, "Input/output error")
+        return super().copy_file(rel_path, src_st)
+
+
+class LocalSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp_dir.name, "source")
+        self.destination = os.path.join(self.tmp_dir.name, "destination")
+        os.mkdir(self.source)
+        os.mkdir(self.destination)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, root, rel_path, content):
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def read(self, rel_path):
+        with open(os.path.join(self.destination, rel_path)) as f:
+            return f.read()
+
+    def sync(self, sync_class=LocalSync, **kwargs):
+        return sync_class(self.source, self.destination,
+                          verbose=False).run(**kwargs)
+
+    def test_full_sync(self):
+        self.write(self.source, "a", "first")
+        self.write(self.source, "dir/b", "second")
+        os.symlink("dir/b", os.path.join(self.source, "link"))
+        self.write(self.destination, "extra/c", "extraneous")
+        self.assertEqual(self.sync(), 0)
+        self.assertEqual(self.read("a"), "first")
+        self.assertEqual(self.read("dir/b"), "second")
+        self.assertEqual(os.readlink(os.path.join(self.destination, "link")),
+                         "dir/b")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.destination, "extra")))
+        self.assertEqual(
+            os.stat(os.path.join(self.source, "a")).st_mtime_ns,
+            os.stat(os.path.join(self.destination, "a")).st_mtime_ns)
+
+    def test_file_replaced_by_directory(self):
+        self.write(self.source, "entry/inside", "content")
+        self.write(self.destination, "entry", "old file")
+        self.assertEqual(self.sync(), 0)
+        self.assertEqual(self.read("entry/inside"), "content")
+
+    def test_no_deletion_after_error(self):
+        self.write(self.source, "broken", "unreadable")
+        self.write(self.source, "fine", "content")
+        self.write(self.destination, "extra", "extraneous")
+        self.assertEqual(self.sync(FailingSync), 1)
+        self.assertEqual(self.read("fine"), "content")
+        self.assertEqual(self.read("extra"), "extraneous")
+
+    def test_targeted_paths(self):
+        self.write(self.source, "dir/changed", "new")
+        self.write(self.source, "untouched", "new")
+        self.write(self.destination, "untouched", "old")
+        self.write(self.destination, "gone", "removed from the source")
+        self.assertEqual(self.sync(paths=["dir/changed", "gone"]), 0)
+        self.assertEqual(self.read("dir/changed"), "new")
+        self.assertEqual(self.read("untouched"), "old")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.destination, "gone")))
+
+
+if __name__ == "__main__":
+    unittest.main()
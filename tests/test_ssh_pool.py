@@ -0,0 +1,30 @@
+import unittest
+from carp.ssh_pool import ssh_destination, remote_destination, \
+    is_local_path, is_daemon_path
+
+
+class RemotePathTest(unittest.TestCase):
+    def test_local_paths(self):
+        for path in ["/media/backup/stash", "backup/stash", "./a:b"]:
+            self.assertTrue(is_local_path(path), path)
+            self.assertIsNone(ssh_destination(path), path)
+            self.assertIsNone(remote_destination(path), path)
+
+    def test_ssh_paths(self):
+        self.assertEqual(ssh_destination("host:stash"), "host")
+        self.assertEqual(ssh_destination("me@host:/srv/stash"), "me@host")
+        self.assertFalse(is_daemon_path("me@host:/srv/stash"))
+
+    def test_daemon_paths(self):
+        for path, host in [("host::module/stash", "host"),
+                           ("me@host::module", "me@host"),
+                           ("rsync://host/module/stash", "host"),
+                           ("rsync://me@host:8873/module", "me@host")]:
+            self.assertFalse(is_local_path(path), path)
+            self.assertTrue(is_daemon_path(path), path)
+            self.assertIsNone(ssh_destination(path), path)
+            self.assertEqual(remote_destination(path), host)
+
+
+if __name__ == "__main__":
+    unittest.main()
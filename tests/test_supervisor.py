@@ -0,0 +1,47 @@
+import unittest
+from carp.supervisor import EventCoalescer
+
+
+class EventCoalescerTest(unittest.TestCase):
+    def net_events(self, *events):
+        coalescer = EventCoalescer(1)
+        for type_names in events:
+            self.assertTrue(coalescer.add(
+                "stash", (None, type_names, "/watched", "file")))
+        return [event[1] for _stash, event in coalescer.pop_ready(True)]
+
+    def test_created_then_deleted(self):
+        self.assertEqual(self.net_events(["IN_CREATE"], ["IN_DELETE"]), [])
+
+    def test_created_then_modified(self):
+        self.assertEqual(
+            self.net_events(["IN_CREATE"], ["IN_MODIFY"], ["IN_MODIFY"]),
+            [["IN_CREATE"]])
+
+    def test_modified_several_times(self):
+        self.assertEqual(
+            self.net_events(["IN_MODIFY"], ["IN_CLOSE_WRITE"], ["IN_MODIFY"]),
+            [["IN_MODIFY"]])
+
+    def test_deleted_then_created(self):
+        self.assertEqual(
+            self.net_events(["IN_DELETE"], ["IN_CREATE"]), [["IN_MODIFY"]])
+
+    def test_modified_then_moved_away(self):
+        self.assertEqual(
+            self.net_events(["IN_MODIFY"], ["IN_MOVED_FROM"]),
+            [["IN_MOVED_FROM"]])
+
+    def test_directory(self):
+        self.assertEqual(
+            self.net_events(["IN_CREATE", "IN_ISDIR"]),
+            [["IN_CREATE", "IN_ISDIR"]])
+
+    def test_watched_directory_events(self):
+        coalescer = EventCoalescer(1)
+        self.assertFalse(coalescer.add(
+            "stash", (None, ["IN_DELETE_SELF"], "/watched", "")))
+
+
+if __name__ == "__main__":
+    unittest.main()
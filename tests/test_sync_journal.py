@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from carp.sync_journal import SyncJournal
+
+
+class SyncJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal_file = os.path.join(self.tmp_dir.name, "sync.journal")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_acknowledge(self):
+        journal = SyncJournal(self.journal_file)
+        journal.record("a")
+        seq = journal.seq
+        journal.record("b")
+        journal.acknowledge(seq)
+        self.assertEqual(journal.changes("P"), ["b"])
+        journal.acknowledge(journal.seq)
+        self.assertFalse(journal.dirty())
+        journal.close()
+
+    def test_reload(self):
+        journal = SyncJournal(self.journal_file)
+        journal.record("a", "C")
+        journal.record("b", "C")
+        journal.acknowledge(journal.seq - 1)
+        journal.close()
+        journal = SyncJournal(self.journal_file)
+        self.assertEqual(journal.changes("C"), ["b"])
+        # Paths of another watch mode cannot be pushed as they are
+        self.assertIsNone(journal.changes("P"))
+        journal.require_full_sync()
+        journal.close()
+        journal = SyncJournal(self.journal_file)
+        self.assertIsNone(journal.changes("C"))
+        journal.close()
+
+    def test_compaction(self):
+        journal = SyncJournal(self.journal_file)
+        journal.compact_threshold = 10
+        for i in range(20):
+            journal.record("file{}".format(i % 3))
+        journal.acknowledge(journal.seq - 1)
+        journal.record("last")
+        journal.close()
+        with open(self.journal_file) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        journal = SyncJournal(self.journal_file)
+        self.assertEqual(journal.changes("P"), ["file1", "last"])
+        self.assertEqual(journal.seq, 21)
+        journal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from carp.tree_snapshot import TreeSnapshot, take_snapshot, diff_snapshots
+
+
+class DiffSnapshotsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        for rel_path in ["a", "dir/b", "dir/sub/c", "gone/d"]:
+            self.write(rel_path, "content")
+        self.snapshot = take_snapshot(self.root)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, rel_path, content):
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_unchanged(self):
+        self.assertEqual(
+            diff_snapshots(self.snapshot, take_snapshot(self.root)),
+            ([], False))
+
+    def test_changes(self):
+        self.write("dir/sub/c", "longer content")
+        self.write("dir/new", "content")
+        os.remove(os.path.join(self.root, "a"))
+        self.assertEqual(
+            diff_snapshots(self.snapshot, take_snapshot(self.root)),
+            (["a", "dir/new", "dir/sub/c"], False))
+
+    def test_removed_directory(self):
+        shutil.rmtree(os.path.join(self.root, "gone"))
+        self.assertEqual(
+            diff_snapshots(self.snapshot, take_snapshot(self.root)),
+            (["gone/d"], True))
+
+    def test_subtrees(self):
+        self.write("dir/sub/c", "longer content")
+        self.write("gone/d", "longer content")
+        # Only the given subtree and its parents are read again
+        snapshot = take_snapshot(self.root, self.snapshot, ["dir/sub"])
+        self.assertEqual(diff_snapshots(self.snapshot, snapshot),
+                         (["dir/sub/c"], False))
+
+    def test_saved_snapshot(self):
+        snapshot_file = os.path.join(self.root, "tree.snapshot")
+        self.snapshot.save(snapshot_file)
+        loaded = TreeSnapshot.load(snapshot_file)
+        self.assertEqual(diff_snapshots(self.snapshot, loaded), ([], False))
+        self.assertIsNotNone(loaded.find_child(0, b"dir"))
+        self.assertIsNone(loaded.find_child(0, b"missing"))
+        loaded.close()
+
+
+if __name__ == "__main__":
+    unittest.main()